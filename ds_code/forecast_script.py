@@ -0,0 +1,132 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "function"))
+from scraper import WeatherScraper
+from model_wrapper import (RandomForestPredictor, GRUPredictor, ConvLSTMPredictor,
+                           add_wind_components, window_inputs, cube_features)
+from utils import to_epoch
+import storage
+
+# script for the hourly forecast: the forecast weather is scraped and preprocessed
+# once, then every model predicts from the shared arrays in its own process
+PREDICTORS = {"random_forest": RandomForestPredictor, "gru": GRUPredictor, "conv_lstm": ConvLSTMPredictor}
+EXTRA_DIR = "data/region/vietnam/extra_info.csv"
+
+
+def save_windows(folder, name, time_idxs, X, init_data):
+    np.save(os.path.join(folder, name + "_X.npy"), X)
+    np.save(os.path.join(folder, name + "_init.npy"), init_data)
+    np.save(os.path.join(folder, name + "_time.npy"), np.concatenate([to_epoch(t) for t in time_idxs]))
+    np.save(os.path.join(folder, name + "_lengths.npy"), np.array([len(t) for t in time_idxs]))
+
+
+def load_windows(folder, name):
+    X = np.load(os.path.join(folder, name + "_X.npy"), mmap_mode="r")
+    init_data = np.load(os.path.join(folder, name + "_init.npy"), mmap_mode="r")
+    time = pd.to_datetime(np.load(os.path.join(folder, name + "_time.npy")), unit="s")
+    lengths = np.load(os.path.join(folder, name + "_lengths.npy"))
+    return np.split(time, np.cumsum(lengths)[:-1]), X, init_data
+
+
+def build_inputs(folder, init_df, input_dir="forecast/weather"):
+    """Read the forecast weather of every province once and save the inputs of every model to `folder`."""
+    frames = [storage.read_table(input_dir, i) for i in init_df.index]
+    save_windows(folder, "random_forest", *window_inputs(frames, init_df))
+    save_windows(folder, "gru", *window_inputs([add_wind_components(df) for df in frames], init_df))
+
+    tables = [(to_epoch(df["time"]), df.drop(columns="time").to_numpy(np.float32), list(df.columns[1:])) for df in frames]
+    cube = storage.Cube.stack(init_df.index.to_numpy(), tables)
+    ids, weather = cube_features(cube)
+    np.save(os.path.join(folder, "conv_lstm_weather.npy"), weather)
+    np.save(os.path.join(folder, "conv_lstm_ids.npy"), ids)
+    np.save(os.path.join(folder, "conv_lstm_time.npy"), cube.time)
+
+
+def publish(staging, output_dir):
+    """
+    Move the files of a fully written staging folder into the output folder one by one.
+    The output folder stays in place and each file is swapped atomically, so readers
+    always find a complete table of every province. Tables not forecast any more are removed last.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    names = set(os.listdir(staging))
+    for name in sorted(names):
+        os.replace(os.path.join(staging, name), os.path.join(output_dir, name))
+    for name in set(os.listdir(output_dir)) - names:
+        path = os.path.join(output_dir, name)
+        if os.path.isfile(path):
+            os.remove(path)
+    os.rmdir(staging)
+
+
+def run_model(name, folder, threads):
+    """Predict with one model from the shared inputs and publish its outputs, returning its timings."""
+    if name == "random_forest":
+        predictor = RandomForestPredictor(n_jobs=threads)
+    else:
+        predictor = PREDICTORS[name](num_threads=threads)
+    output_dir = predictor.output_dir
+    predictor.output_dir = output_dir + ".staging"
+    shutil.rmtree(predictor.output_dir, ignore_errors=True)
+    os.makedirs(predictor.output_dir)
+
+    start = perf_counter()
+    if name == "conv_lstm":
+        ids = np.load(os.path.join(folder, "conv_lstm_ids.npy"))
+        time_idx = pd.to_datetime(np.load(os.path.join(folder, "conv_lstm_time.npy")), unit="s")
+        output = predictor.predict_weather(np.load(os.path.join(folder, "conv_lstm_weather.npy"), mmap_mode="r")).reshape(-1, 6)
+        time_idxs = [time_idx] * len(ids)
+    else:
+        ids = pd.read_csv(EXTRA_DIR)["id"].to_numpy()
+        time_idxs, X, init_data = load_windows(folder, name)
+        output = predictor.predict(X, init_data)
+    predictor.timings["predict"] = perf_counter() - start
+
+    start = perf_counter()
+    predictor.store_all(ids, time_idxs, output)
+    publish(predictor.output_dir, output_dir)
+    predictor.timings["store"] = perf_counter() - start
+    return predictor.timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape the forecast weather and forecast the air quality with every model.")
+    parser.add_argument("--models", nargs="+", choices=list(PREDICTORS), default=list(PREDICTORS))
+    parser.add_argument("--skip-scrape", action="store_true", help="use the forecast weather already in forecast/weather")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="threads shared by the models")
+    args = parser.parse_args()
+    timings = {}
+
+    start = perf_counter()
+    if not args.skip_scrape:
+        WeatherScraper().forecast_scrape(pd.read_csv("data/region/vietnam/cities.csv"))
+    timings["scrape"] = {"total": perf_counter() - start}
+
+    with tempfile.TemporaryDirectory() as folder:
+        start = perf_counter()
+        init_df = pd.read_csv(EXTRA_DIR).set_index("id")
+        build_inputs(folder, init_df)
+        timings["preprocess"] = {"total": perf_counter() - start}
+
+        # spawned workers, forked ones would inherit the thread pools of torch
+        threads = max(1, args.threads // len(args.models))
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(len(args.models), mp_context=context) as pool:
+            futures = {pool.submit(run_model, name, folder, threads): name for name in args.models}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    timings[name] = future.result()
+                    timings[name]["total"] = sum(timings[name].values())
+                except Exception as e:
+                    print(f"Error: {name} forecast failed ({type(e).__name__}: {e})")
+
+    print(pd.DataFrame.from_dict(timings, orient="index").round(3))
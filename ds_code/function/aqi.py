@@ -0,0 +1,126 @@
+import os
+import numpy as np
+from utils import cube_folder, read_cube
+import storage
+
+# Breakpoint tables of AQI.ipynb: (C_low, C_high, I_low, I_high) per pollutant,
+# concentrations in μg/m³ as stored by the scraper.
+BREAKPOINTS = {
+    'pm2_5': [(0, 35, 0, 50), (36, 75, 51, 100), (76, 115, 101, 150), (116, 150, 151, 200), 
+              (151, 250, 201, 300), (251, 350, 301, 400), (351, 500, 401, 500)],
+    'pm10': [(0, 50, 0, 50), (51, 150, 51, 100), (151, 250, 101, 150), (251, 350, 151, 200), 
+             (351, 420, 201, 300), (421, 500, 301, 400), (501, 600, 401, 500)],
+    'o3': [(0, 160, 0, 50), (161, 200, 51, 100), (201, 300, 101, 150), (301, 400, 151, 200), 
+           (401, 800, 201, 300), (801, 1000, 301, 400), (1001, 1200, 401, 500)],
+    'co': [(0, 5000, 0, 50), (5001, 10000, 51, 100), (10001, 35000, 101, 150), (35001, 60000, 151, 200), 
+           (60001, 90000, 201, 300), (90001, 120000, 301, 400), (120001, 150000, 401, 500)],
+    'no2': [(0, 100, 0, 50), (101, 200, 51, 100), (201, 700, 101, 150), (701, 1200, 151, 200), 
+            (1201, 2340, 201, 300), (2341, 3090, 301, 400), (3091, 3840, 401, 500)],
+    'so2': [(0, 150, 0, 50), (151, 500, 51, 100), (501, 650, 101, 150), (651, 800, 151, 200), 
+            (801, 1600, 201, 300), (1601, 2100, 301, 400), (2101, 2620, 401, 500)]
+}
+POLLUTANTS = ["co", "no2", "o3", "so2", "pm2_5", "pm10"]
+# hours of the trailing mean each sub-index is computed on
+AVERAGING = {"co": 8, "no2": 1, "o3": 8, "so2": 1, "pm2_5": 24, "pm10": 24}
+
+
+def sub_index(concentration, pollutant):
+    """
+    Sub-index of an array of concentrations, interpolated in its breakpoint segment.
+    Values falling between two segments (e.g. 35.5 for pm2_5) take the lower index
+    of the next segment; negative, missing and off-table values give NaN.
+    """
+    table = np.array(BREAKPOINTS[pollutant], dtype=np.float64)
+    c_low, c_high, i_low, i_high = table.T
+    concentration = np.asarray(concentration, dtype=np.float64)
+    seg = np.minimum(np.searchsorted(c_high, concentration, side="left"), len(table) - 1)
+    clipped = np.maximum(concentration, c_low[seg])
+    index = (i_high[seg] - i_low[seg]) / (c_high[seg] - c_low[seg]) * (clipped - c_low[seg]) + i_low[seg]
+    return np.where((concentration >= 0) & (concentration <= c_high[-1]), index, np.nan)
+
+
+def rolling_mean(values, window, min_fraction=0.75):
+    """
+    Trailing mean over `window` steps of the first axis, ignoring NaN.
+    Means over less than `min_fraction` of valid values are NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if window == 1:
+        return values.copy()
+    valid = np.isfinite(values)
+    zeros = np.zeros((1,) + values.shape[1:])
+    sums = np.concatenate((zeros, np.cumsum(np.where(valid, values, 0), axis=0)))
+    counts = np.concatenate((zeros, np.cumsum(valid, axis=0)))
+    start = np.maximum(np.arange(1, len(values) + 1) - window, 0)
+    window_sums, window_counts = sums[1:] - sums[start], counts[1:] - counts[start]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(window_counts >= np.ceil(min_fraction * window), window_sums / window_counts, np.nan)
+
+
+def compute_aqi(values, pollutants=POLLUTANTS, averaged=True, min_fraction=0.75):
+    """
+    Sub-indices and AQI of an array of shape (hours, ..., pollutants).
+    Returns an array of the same shape with one more feature, the AQI as the
+    maximum of the available sub-indices.
+    """
+    values = np.asarray(values)
+    out = np.full(values.shape[:-1] + (len(pollutants) + 1,), np.nan, dtype=np.float32)
+    for i, pollutant in enumerate(pollutants):
+        concentration = values[..., i]
+        if averaged:
+            concentration = rolling_mean(concentration, AVERAGING[pollutant], min_fraction)
+        out[..., i] = sub_index(concentration, pollutant)
+    finite = np.isfinite(out[..., :-1])
+    out[..., -1] = np.where(finite.any(axis=-1), np.where(finite, out[..., :-1], -np.inf).max(axis=-1), np.nan)
+    return out
+
+
+def aqi_cube(cube, history=None, averaged=True, min_fraction=0.75):
+    """
+    Cube of sub-indices and AQI of a pollutant cube. The hours of `history`
+    (e.g. the scraped air quality before a forecast) preceding the cube fill
+    the trailing means of its first hours.
+    """
+    values = cube.take(features=POLLUTANTS)
+    lead = max(AVERAGING.values()) - 1 if averaged and history is not None else 0
+    if lead:
+        prefix = np.full((lead,) + values.shape[1:], np.nan, dtype=np.float32)
+        before = history.slice_time(end=cube.time_index[0]).slice_time(start=cube.time_index[0] - lead * np.timedelta64(1, "h"))
+        prefix[(before.time - cube.time[0]) // 3600 + lead] = before.take(cube.provinces, POLLUTANTS)
+        values = np.concatenate((prefix, values))
+    out = compute_aqi(values, POLLUTANTS, averaged, min_fraction)[lead:]
+    return storage.Cube(cube.time, cube.provinces, POLLUTANTS + ["aqi"], out)
+
+
+def aqi_folder(region_folder, src_folder, src='data'):
+    return cube_folder(region_folder, src_folder + "_aqi", src)
+
+
+def history_changed(folder, region_folder):
+    """Whether the scraped air quality cube, or its city files, changed after the AQI cube in `folder` was saved."""
+    history_folder = cube_folder(region_folder, "air_quality")
+    if storage.cube_is_stale(history_folder, "data/air_quality"):
+        return True
+    saved = os.path.getmtime(os.path.join(folder, "meta.json"))
+    return any(os.path.getmtime(os.path.join(history_folder, name)) > saved for name in ["time.npy", "values.npy"])
+
+
+def read_aqi(region_folder, src_folder, src='data', history=True, mmap=True):
+    """
+    Memory-map the AQI cube of a pollutant cube, computing it again if the city files changed.
+    Forecasts use the scraped air quality as history for their trailing means, and are
+    computed again when it changes too.
+    """
+    folder = aqi_folder(region_folder, src_folder, src)
+    history = history and src != 'data'
+    if storage.cube_is_stale(folder, src + '/' + src_folder) or history and history_changed(folder, region_folder):
+        cube = read_cube(region_folder, src_folder, src)
+        history = read_cube(region_folder, "air_quality") if history else None
+        aqi_cube(cube, history).save(folder)
+    return storage.Cube.load(folder, mmap)
+
+
+if __name__ == "__main__":
+    read_aqi("vietnam", "air_quality")
+    for model in ["random_forest", "gru", "conv_lstm"]:
+        read_aqi("vietnam", "aqi/" + model, src="forecast")
@@ -0,0 +1,242 @@
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from model_wrapper import RandomForestPredictor, GRUPredictor, ConvLSTMPredictor, cube_features
+from utils import predict_window, read_cube, to_epoch
+import storage
+
+# Rolling-origin backtest of the forecasters on the history in data/. At every origin
+# the models forecast the next `horizon` hours from the observed weather (standing in
+# for the forecast weather) with `context` hours before the origin, as the forecast
+# script does with past_days=1. The models map a weather window to the air quality of
+# its last hour, so once `context` covers a window every origin predicts a target hour
+# the same way: each hour is predicted once, in blocks spread over processes, and the
+# origins select which (origin, horizon) hours are scored.
+#
+# The ConvLSTM of conv_lstm.ipynb is trained on the hours up to 2023-12-31, the default
+# range starts after them. RandomForest and GRU are trained on a random split of every
+# window of the history, so any range overlaps their training windows: their scores are
+# optimistic. ConvLSTM inputs are filled across scraping gaps while the windows of the
+# others with a gap are skipped, so by default every model is scored on the (hour, province)
+# pairs predicted by all of them (--all-hours scores each model on its own predictions).
+#
+#   python ds_code/function/backtest.py --start 2024-01-01 --end 2024-11-01 --origins daily
+POLLUTANTS = ["co", "no2", "o3", "so2", "pm2_5", "pm10"]
+START = "2024-01-01"
+END = "2024-11-01"
+PREDICTORS = {"random_forest": RandomForestPredictor, "gru": GRUPredictor, "conv_lstm": ConvLSTMPredictor}
+EXTRA_DIR = "data/region/vietnam/extra_info.csv"
+_predictors = {}
+
+
+def origins_range(start, end, freq="daily"):
+    """Epochs of the forecast origins in [start, end), every hour or every day."""
+    index = pd.date_range(start, end, freq="h" if freq == "hourly" else "D", inclusive="left")
+    return to_epoch(index)
+
+
+def get_predictor(name, threads=None):
+    """Predictor of a model, loaded once per process."""
+    if name not in _predictors:
+        if name == "random_forest":
+            _predictors[name] = RandomForestPredictor(n_jobs=threads or -1)
+        else:
+            _predictors[name] = PREDICTORS[name](num_threads=threads, batch_size=4096 if name == "gru" else 256)
+        _predictors[name].input_dir = "data/weather"
+    return _predictors[name]
+
+
+def predict_block(name, start, stop, context=24, threads=None):
+    """
+    Predictions of shape (hours, provinces, pollutants) of one model for the hours [start, stop)
+    (epochs), from the weather starting `context` hours earlier. Provinces follow extra_info.csv,
+    hours without a complete weather window are NaN.
+    """
+    predictor = get_predictor(name, threads)
+    ids = pd.read_csv(EXTRA_DIR)["id"].to_numpy()
+    time = np.arange(start, stop, 3600, dtype=np.int64)
+    output = np.full((len(time), len(ids), len(POLLUTANTS)), np.nan, dtype=np.float32)
+    first = pd.Timestamp(start - context * 3600, unit="s")
+    last = pd.Timestamp(stop, unit="s")
+
+    if name == "conv_lstm":
+        cube = read_cube("vietnam", "weather").slice_time(first, last)
+        order, weather = cube_features(cube)
+        # the provinces are channels of one image, fill the scraping gaps so one gap does not blank every province
+        weather = np.stack([pd.DataFrame(province).ffill().bfill().to_numpy() for province in weather])
+        prediction = predictor.predict_weather(weather).transpose(1, 0, 2)
+        rows = (cube.time - start) // 3600
+        keep = (rows >= 0) & (rows < len(time))
+        output[rows[keep][:, None], pd.Index(ids).get_indexer(order)[None, :]] = prediction[keep]
+        return output
+
+    init_df = pd.read_csv(EXTRA_DIR).set_index("id")
+    Xs, init_data, positions = [], [], []
+    for p, i in enumerate(ids):
+        weather_df = predictor.get_dataframe(i)
+        weather_df = weather_df[(weather_df["time"] >= first) & (weather_df["time"] < last)]
+        time_idx, X = predict_window(weather_df, copy=False)
+        rows = (to_epoch(time_idx) - start) // 3600
+        keep = (rows >= 0) & np.isfinite(X).all(axis=(1, 2))
+        Xs.append(X[keep])
+        init_data.append(np.repeat(init_df.loc[[i]].to_numpy()[:, :3], keep.sum(), axis=0))
+        positions.append(np.stack((rows[keep], np.full(keep.sum(), p)), axis=1))
+    X, init_data, positions = np.concatenate(Xs), np.concatenate(init_data), np.concatenate(positions)
+    # the windows of every province and origin of the block go through the model together
+    if len(X):
+        output[positions[:, 0], positions[:, 1]] = predictor.predict(X, init_data)
+    return output
+
+
+def observed(start, stop):
+    """Observed pollutants of shape (hours, provinces, pollutants) for [start, stop), NaN where invalid."""
+    ids = pd.read_csv(EXTRA_DIR)["id"].to_numpy()
+    cube = read_cube("vietnam", "air_quality").slice_time(pd.Timestamp(start, unit="s"), pd.Timestamp(stop, unit="s"))
+    time = np.arange(start, stop, 3600, dtype=np.int64)
+    values = np.full((len(time), len(ids), len(POLLUTANTS)), np.nan, dtype=np.float32)
+    truth = np.asarray(cube.take(ids, POLLUTANTS), dtype=np.float32)
+    values[(cube.time - start) // 3600] = np.where(truth >= 0, truth, np.nan)
+    return values
+
+
+def run(models, origins, horizon=24, context=24, workers=None, block_days=30, threads=None):
+    """
+    Predict every hour covered by the origins with every model, in blocks of `block_days`
+    days spread over `workers` processes. Return (time, provinces, {model: predictions}, truth).
+    """
+    start, stop = int(origins[0]), int(origins[-1]) + horizon * 3600
+    step = block_days * 24 * 3600
+    blocks = [(a, min(a + step, stop)) for a in range(start, stop, step)]
+    workers = workers or min(os.cpu_count(), len(blocks) * len(models))
+    threads = threads or max(1, os.cpu_count() // workers)
+    if "conv_lstm" in models:
+        # group the cube once here rather than in every worker at the same time
+        read_cube("vietnam", "weather")
+
+    # spawned workers, forked ones would inherit the thread pools of torch
+    context_ = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context_) as pool:
+        futures = {name: [pool.submit(predict_block, name, a, b, context, threads) for a, b in blocks] for name in models}
+        predictions = {name: np.concatenate([future.result() for future in block_futures])
+                       for name, block_futures in futures.items()}
+    time = np.arange(start, stop, 3600, dtype=np.int64)
+    provinces = pd.read_csv(EXTRA_DIR)["id"].to_numpy()
+    return time, provinces, predictions, observed(start, stop)
+
+
+def save_results(folder, time, provinces, predictions, truth):
+    """
+    Store the predictions as one column per .npy file of `folder`: model (code of the model
+    names in meta.json), time, province, the predicted pollutants and the observed ones (true_*).
+    """
+    os.makedirs(folder, exist_ok=True)
+    names = list(predictions)
+    n = len(time) * len(provinces)
+    columns = {
+        "model": np.repeat(np.arange(len(names), dtype=np.int8), n),
+        "time": np.tile(np.repeat(time, len(provinces)), len(names)),
+        "province": np.tile(provinces, len(time) * len(names)),
+    }
+    for k, pollutant in enumerate(POLLUTANTS):
+        columns[pollutant] = np.concatenate([predictions[name][:, :, k].ravel() for name in names])
+        columns["true_" + pollutant] = np.tile(truth[:, :, k].ravel(), len(names))
+    for column, values in columns.items():
+        storage._replace(os.path.join(folder, column + ".npy"), lambda tmp_path: storage._save(tmp_path, values))
+    with open(os.path.join(folder, "meta.json"), "w") as f:
+        json.dump({"models": names, "columns": list(columns), "pollutants": POLLUTANTS}, f)
+
+
+def load_results(folder, columns=None):
+    """Dataframe of stored backtest results, the columns memory-mapped until they are used."""
+    with open(os.path.join(folder, "meta.json")) as f:
+        meta = json.load(f)
+    df = pd.DataFrame({column: np.load(os.path.join(folder, column + ".npy"), mmap_mode="r")
+                       for column in columns or meta["columns"]})
+    if "model" in df:
+        df["model"] = pd.Categorical.from_codes(df["model"], meta["models"])
+    return df
+
+
+def _metrics(sums, keys, name):
+    """Dataframe of n, RMSE, MAE and bias per key and pollutant from the (keys, pollutants) error sums."""
+    n, se, ae, e = sums
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats = {"n": n, "rmse": np.sqrt(se / n), "mae": ae / n, "bias": e / n}
+    index = pd.MultiIndex.from_product([keys, POLLUTANTS], names=[name, "pollutant"])
+    return pd.DataFrame({stat: values.ravel() for stat, values in stats.items()}, index=index)
+
+
+def evaluate(time, provinces, prediction, truth, origins, horizon=24):
+    """
+    Error metrics of one model: overall, per province, per origin (over its horizon)
+    and per horizon step, each per pollutant, from vectorized sums over the hour axis.
+    """
+    error = prediction - truth
+    valid = np.isfinite(error)
+    error = np.where(valid, error, 0)
+    # (stat, hours, provinces, pollutants) of the count, squared, absolute and signed errors
+    stats = np.stack((valid.astype(np.float64), error.astype(np.float64) ** 2, np.abs(error), error))
+    per_hour = stats.sum(axis=2)
+
+    rows = (np.asarray(origins) - time[0]) // 3600
+    cumulative = np.concatenate((np.zeros_like(per_hour[:, :1]), np.cumsum(per_hour, axis=1)), axis=1)
+    per_origin = cumulative[:, rows + horizon] - cumulative[:, rows]
+    per_horizon = per_hour[:, rows[:, None] + np.arange(horizon)].sum(axis=1)
+
+    # the hours scored are the union of the origin horizons
+    scored = np.zeros(len(time), dtype=bool)
+    scored[(rows[:, None] + np.arange(horizon)).ravel()] = True
+    return {
+        "overall": _metrics(per_hour[:, scored].sum(axis=1, keepdims=True), ["all"], "scope"),
+        "province": _metrics(stats[:, scored].sum(axis=1), provinces, "province"),
+        "origin": _metrics(per_origin, pd.to_datetime(origins, unit="s"), "origin"),
+        "horizon": _metrics(per_horizon, np.arange(horizon), "horizon"),
+    }
+
+
+def common_hours(predictions):
+    """Mask of the (hour, province) pairs every model has a prediction for, shape (hours, provinces)."""
+    return np.logical_and.reduce([np.isfinite(prediction).all(axis=2) for prediction in predictions.values()])
+
+
+def backtest(models, start=START, end=END, freq="daily", horizon=24, context=24, workers=None, output=None, common=True):
+    """
+    Run the backtest of the models and return {model: metrics}, saving the results to `output`.
+    With `common`, every model is scored on the hours and provinces predicted by all of them.
+    """
+    origins = origins_range(start, end, freq)
+    clock = perf_counter()
+    time, provinces, predictions, truth = run(models, origins, horizon, context, workers)
+    print(f"Predicted {len(time)} hours of {len(provinces)} provinces with {len(models)} models in {perf_counter() - clock:.1f}s")
+    if output:
+        save_results(output, time, provinces, predictions, truth)
+    if common:
+        mask = common_hours(predictions)[:, :, None]
+        predictions = {name: np.where(mask, prediction, np.nan) for name, prediction in predictions.items()}
+    return {name: evaluate(time, provinces, prediction, truth, origins, horizon) for name, prediction in predictions.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rolling-origin backtest of the forecasters on the history in data/.")
+    parser.add_argument("--models", nargs="+", choices=list(PREDICTORS), default=list(PREDICTORS))
+    parser.add_argument("--start", default=START, help="first origin, after the ConvLSTM training hours by default")
+    parser.add_argument("--end", default=END)
+    parser.add_argument("--origins", choices=["hourly", "daily"], default="daily")
+    parser.add_argument("--horizon", type=int, default=24, help="hours forecast from each origin")
+    parser.add_argument("--context", type=int, default=24, help="hours of weather before each origin")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="backtest/results")
+    parser.add_argument("--all-hours", action="store_true", help="score each model on all of its predictions")
+    args = parser.parse_args()
+
+    results = backtest(args.models, args.start, args.end, args.origins, args.horizon, args.context, args.workers,
+                       args.output, common=not args.all_hours)
+    for name, tables in results.items():
+        print(name)
+        # n is the number of (hour, province) pairs scored
+        print(tables["overall"].droplevel("scope").round(3))
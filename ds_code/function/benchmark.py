@@ -0,0 +1,387 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import threading
+import numpy as np
+import pandas as pd
+from time import perf_counter
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# End-to-end benchmarks of the scrape -> group -> window -> train -> forecast -> render
+# pipeline. Each benchmark runs in its own process, inside a temporary copy of data/,
+# forecast/ and models/, so peak RSS is measured per stage and the trees stay untouched.
+# Run from the repository root:
+#   python ds_code/function/benchmark.py --save         record benchmarks/baseline.json
+#   python ds_code/function/benchmark.py                compare against it
+# The checked-in baseline records the machine and settings it was measured with, timings
+# are only comparable on a similar machine: record a local one with --save first.
+# Missing trained models are replaced by stand-ins of the same architecture (stand_in=true).
+
+BASELINE = "benchmarks/baseline.json"
+COPIED = ["data/weather", "data/air_quality", "data/region", "forecast", "models"]
+BENCHMARKS = {}
+STAND_INS = []                      # model files written by stand_in_model in this process
+MIN_REPEAT = 3
+
+
+class Skip(Exception):
+    pass
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function does the setup and returns
+    (run, rows): the callable that is timed and the rows it processes per call.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def require(*paths):
+    for path in paths:
+        if not os.path.exists(path):
+            raise Skip(f"{path} not found")
+
+
+def cities():
+    return pd.read_csv("data/region/vietnam/cities.csv")
+
+
+def table_rows(folder):
+    import storage
+    return sum(len(storage.read_records(folder, i)) for i in cities()["id"])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answer the Open-Meteo and OpenWeatherMap requests of the scrapers with random hourly data."""
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        rng = np.random.default_rng(0)
+        if url.path == "/weather":
+            start = datetime.strptime(query["start"], "%Y-%m-%d")
+            hours = (datetime.strptime(query["end"], "%Y-%m-%d") - start).days * 24 + 24
+            hourly = {"time": [(start + timedelta(hours=h)).strftime("%Y-%m-%dT%H:%M") for h in range(hours)]}
+            for var in ["temperature_2m", "relative_humidity_2m", "dew_point_2m", "precipitation",
+                        "surface_pressure", "cloud_cover", "wind_speed_10m", "wind_direction_10m"]:
+                hourly[var] = rng.uniform(0, 100, hours).round(1).tolist()
+            body = {"hourly": hourly}
+        else:
+            stamps = range(int(query["start"]), int(query["end"]), 3600)
+            components = ["co", "no", "no2", "o3", "so2", "pm2_5", "pm10", "nh3"]
+            body = {"list": [{"dt": dt, "main": {"aqi": 1}, "components": dict(zip(components, rng.uniform(0, 100, 8).round(2).tolist()))}
+                             for dt in stamps]}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@benchmark("scrape")
+def bench_scrape(days=30):
+    from scraper import WeatherScraper, AQIScraper
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    weather_scraper, aqi_scraper = WeatherScraper(rate=None), AQIScraper(rate=None)
+    weather_scraper.raw_url = base + "/weather?lat={}&lng={}&start={}&end={}"
+    aqi_scraper.raw_url = base + "/aqi?lat={}&lon={}&start={}&end={}"
+    weather_scraper.folder, aqi_scraper.folder = "bench/weather", "bench/air_quality"
+    os.makedirs("bench/weather", exist_ok=True)
+    os.makedirs("bench/air_quality", exist_ok=True)
+    df = cities()
+    end = (datetime(2024, 1, 1) + timedelta(days=days - 1)).strftime("%Y-%m-%d")
+
+    def run():
+        weather_scraper.mass_scrape(df, "2024-01-01", end)
+        aqi_scraper.mass_scrape(df, "2024-01-01", end)
+    return run, 2 * len(df) * days * 24
+
+
+@benchmark("group_data")
+def bench_group_data():
+    from utils import group_data
+    return (lambda: group_data("vietnam", "weather", None, to_csv=False)), table_rows("data/weather")
+
+
+@benchmark("group_cube")
+def bench_group_cube():
+    from utils import group_cube
+    return (lambda: group_cube("vietnam", "weather")), table_rows("data/weather")
+
+
+@benchmark("sliding_window")
+def bench_sliding_window():
+    from utils import sliding_window
+    import storage
+    tables = [(storage.read_table("data/weather", i).dropna(), storage.read_table("data/air_quality", i).drop(columns="aqi"))
+              for i in cities()["id"]]
+    rows = sum(len(sliding_window(w, a, target_size="one", copy=False)[0]) for w, a in tables)
+    return (lambda: [sliding_window(w, a, target_size="one") for w, a in tables]), rows
+
+
+@benchmark("predict_window")
+def bench_predict_window():
+    from utils import predict_window
+    import storage
+    tables = [storage.read_table("forecast/weather", i) for i in cities()["id"]]
+    rows = sum(len(predict_window(w)[1]) for w in tables)
+    return (lambda: [predict_window(w) for w in tables]), rows
+
+
+@benchmark("train_gru")
+def bench_train_gru(samples=20000, batch_size=512):
+    import torch
+    from utils import sliding_window
+    from models import CustomGRU, StandardScaler
+    import storage
+    i = cities()["id"][0]
+    weather_df = storage.read_table("data/weather", i).dropna()
+    air_df = storage.read_table("data/air_quality", i).drop(columns="aqi")
+    X, y = sliding_window(weather_df, air_df)
+    X, y = torch.tensor(X[-samples:]), torch.tensor(y[-samples:])
+    init_data = torch.zeros(len(X), 3)
+    model = CustomGRU(X.shape[-1], y.shape[-1], label_scaler=StandardScaler())
+    optimizer = torch.optim.Adam(model.parameters())
+    loss_fn = torch.nn.MSELoss()
+
+    def run():
+        model.train()
+        for start in range(0, len(X), batch_size):
+            batch = slice(start, start + batch_size)
+            optimizer.zero_grad()
+            loss = loss_fn(model((X[batch], init_data[batch])), y[batch])
+            loss.backward()
+            optimizer.step()
+    return run, len(X)
+
+
+def stand_in_model(model_dir, samples=20000):
+    """
+    Write a model of the trained architecture with random weights to `model_dir` (inside the
+    temporary copy). The trained models are not in the repository; the ConvLSTM and GRU
+    cost the same with any weights, the forest follows the settings of random_forest.ipynb.
+    """
+    import torch
+    import joblib
+    from models import ConvLSTMTimeSeries, CustomGRU, StandardScaler
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    if model_dir.endswith("conv_lstm.pth"):
+        model = ConvLSTMTimeSeries(input_dim=63, hidden_dim=[256], input_width=9, output_width=6)
+        torch.save(model.state_dict(), model_dir)
+    elif model_dir.endswith("gru.pth"):
+        label_scaler = StandardScaler()
+        label_scaler.fit(torch.rand(100, 6) * 100)
+        torch.save(CustomGRU(input_size=9, output_size=6, seq_len=4, label_scaler=label_scaler), model_dir)
+    else:
+        from sklearn.compose import TransformedTargetRegressor
+        from sklearn.ensemble import RandomForestRegressor
+        from sklearn.pipeline import Pipeline
+        from sklearn.preprocessing import StandardScaler as ScikitScaler
+        forest = RandomForestRegressor(n_estimators=30, max_depth=20, min_samples_leaf=2, random_state=0)
+        model = TransformedTargetRegressor(regressor=Pipeline([("scaler", ScikitScaler()), ("forest", forest)]),
+                                           transformer=ScikitScaler())
+        joblib.dump(model.fit(rng.random((samples, 35)), rng.random((samples, 6))), model_dir, compress=3)
+    STAND_INS.append(model_dir)
+
+
+def bench_forecast(predictor_cls, model_dir):
+    if not os.path.exists(model_dir):
+        stand_in_model(model_dir)
+    import model_wrapper
+    predictor = getattr(model_wrapper, predictor_cls)()
+    rows = table_rows("forecast/weather")
+    if predictor_cls == "ConvLSTMPredictor":
+        return predictor.forecast, rows
+    return (lambda: predictor.forecast("data/region/vietnam/extra_info.csv")), rows
+
+
+@benchmark("forecast_random_forest")
+def bench_forecast_random_forest():
+    return bench_forecast("RandomForestPredictor", "models/random_forest.pkl")
+
+
+@benchmark("forecast_gru")
+def bench_forecast_gru():
+    return bench_forecast("GRUPredictor", "models/gru.pth")
+
+
+@benchmark("forecast_conv_lstm")
+def bench_forecast_conv_lstm():
+    return bench_forecast("ConvLSTMPredictor", "models/conv_lstm.pth")
+
+
+@benchmark("dataset_getitem")
+def bench_dataset_getitem(hours=8760):
+    import joblib
+    from utils import read_cube
+    from models import TimeSeries3DDataset
+    from model_wrapper import ConvLSTMPredictor
+    # get_features only needs the cities file, not a loaded model
+    weather = ConvLSTMPredictor.__new__(ConvLSTMPredictor).get_features(read_cube("vietnam", "weather").slice_time(end="2024-01-01"))[:, -hours:]
+    custom_scaler = joblib.load("models/weather_scaler.pickle"), joblib.load("models/air_scaler.pickle")
+    dataset = TimeSeries3DDataset(None, np.nan_to_num(weather), 63, 3, custom_scaler=custom_scaler, predict=True)
+    return (lambda: [dataset[i] for i in range(len(dataset))]), len(dataset)
+
+
+def map_app():
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from PyQt5.QtWidgets import QApplication
+        sys.path.append("vnmap")
+        from gui import MapApp
+    except ImportError as e:
+        raise Skip(str(e))
+    require("vnmap/vn_shp/vn.shp")
+    app = QApplication.instance() or QApplication([])
+    return app, MapApp()
+
+
+@benchmark("map_payload")
+def bench_map_payload(frames=24):
+    app, window = map_app()
+    times = window.repository.get("aqi", "gru").time_index[:frames].strftime("%Y-%m-%dT%H:00")
+
+    def run():
+        window.payload_cache.clear()
+        for t in times:
+            window.get_payload("aqi", "gru", "pm2_5", t)
+    return run, frames * len(window.province_ids)
+
+
+@benchmark("create_map")
+def bench_create_map():
+    app, window = map_app()
+    return window.create_map, len(window.province_ids)
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def run_benchmark(name, repeat):
+    """Set up and time one benchmark in this process, returning its result row."""
+    try:
+        run, rows = BENCHMARKS[name]()
+    except Skip as e:
+        return {"name": name, "skipped": str(e)}
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        run()
+        times.append(perf_counter() - start)
+    seconds = float(np.median(times))
+    return {"name": name, "seconds": round(seconds, 4), "best": round(min(times), 4), "rows": rows,
+            "rows_per_sec": round(rows / seconds, 1) if rows else None, "peak_rss_mb": round(peak_rss_mb(), 1),
+            "stand_in": bool(STAND_INS)}
+
+
+def run_suite(names, repeat, root="."):
+    """Run benchmarks in child processes inside a temporary copy of the trees."""
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for path in COPIED:
+            if os.path.exists(os.path.join(root, path)):
+                shutil.copytree(os.path.join(root, path), os.path.join(workdir, path))
+        os.symlink(os.path.abspath(os.path.join(root, "vnmap")), os.path.join(workdir, "vnmap"))
+        for name in names:
+            print(f"running {name}...", flush=True)
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", name, "--repeat", str(repeat)],
+                                     cwd=workdir, capture_output=True, text=True)
+            lines = process.stdout.strip().splitlines()
+            if process.returncode != 0 or not lines:
+                results.append({"name": name, "skipped": "failed: " + (process.stderr.strip().splitlines() or ["?"])[-1]})
+            else:
+                results.append(json.loads(lines[-1]))
+    return results
+
+
+def machine():
+    """Description of this machine and library versions, saved with the baseline."""
+    return {"platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(), "python": platform.python_version(),
+            "numpy": np.__version__, "pandas": pd.__version__}
+
+
+def load_baseline(path):
+    """Result rows of a saved baseline, warning when it was measured on another machine."""
+    with open(path) as f:
+        baseline = json.load(f)
+    if isinstance(baseline, list):              # baselines saved before the machine was recorded
+        return baseline
+    if baseline["machine"] != machine():
+        print(f"warning: {path} was measured on another machine ({baseline['machine']['processor']}, "
+              f"{baseline['machine']['cpus']} cpus), timings may not be comparable")
+    return baseline["results"]
+
+
+def compare(results, baseline, tolerance=0.2, min_change={"seconds": 0.05, "peak_rss_mb": 20}):
+    """
+    Result table with the change against the baseline, and the names of the regressed benchmarks:
+    those slower or larger by more than `tolerance` and by more than the `min_change` of the
+    column, so that the jitter of the short benchmarks is not reported.
+    """
+    df = pd.DataFrame(results).set_index("name")
+    regressed = []
+    if baseline:
+        base = pd.DataFrame(baseline).set_index("name").reindex(df.index)
+        for col in ["seconds", "peak_rss_mb"]:
+            if col in df and col in base:
+                df[col + "_change_%"] = (100 * (df[col] / base[col] - 1)).round(1)
+                worse = (df[col] > base[col] * (1 + tolerance)) & (df[col] - base[col] > min_change[col])
+                regressed += df.index[worse].tolist()
+    return df, sorted(set(regressed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against the checked-in data.")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all by default: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=MIN_REPEAT, help="runs per benchmark, the median is kept")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown/growth before a regression is reported")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_benchmark(args.child, args.repeat)))
+        sys.exit(0)
+
+    names = args.names or list(BENCHMARKS)
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save:
+        baseline = load_baseline(args.baseline)
+    if (baseline or args.save) and args.repeat < MIN_REPEAT:
+        # the median of fewer runs flags noise as regressions
+        print(f"using --repeat {MIN_REPEAT} to compare with or save a baseline")
+        args.repeat = MIN_REPEAT
+    results = run_suite(names, args.repeat)
+    df, regressed = compare(results, baseline, args.tolerance)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(df)
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"created": datetime.now().isoformat(timespec="seconds"), "machine": machine(),
+                       "settings": {"repeat": args.repeat, "names": names}, "results": results}, f, indent=4)
+        print(f"baseline saved to {args.baseline}")
+    elif regressed:
+        print("regressions: " + ", ".join(regressed))
+        sys.exit(1)
@@ -0,0 +1,198 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from utils import cube_folder
+import storage
+import coverage_index
+import metrics
+
+# The rules of data_cleaning.ipynb on (hour, province, feature) cubes keyed by province id:
+# - an (hour, province) row with a negative or missing value is removed,
+# - weather and air quality are restricted to their common time range and to the
+#   (hour, province) rows present in both ("cleaned"),
+# - "dropped" keeps only the hours where every province is present in both,
+# - "interpolated" fills every gap of the cleaned cubes linearly in time, holding
+#   the first/last value of a series before/after it.
+# Cleaned and interpolated cubes are saved under data/region/<region>/cleaned and
+# .../interpolated, and are updated with only the hours scraped since the last run.
+SOURCES = {"weather": "weather", "air_quality": "air"}
+
+
+def read_province(folder, province, since=None, columns=None):
+    """(epochs, values, columns) of a province table after `since`, removing rows with a negative or missing value."""
+    epochs, values, columns = storage.read_arrays(folder, province, columns)
+    if since is not None:
+        start = np.searchsorted(epochs, since, side="right")
+        epochs, values = epochs[start:], values[start:]
+    keep = (values >= 0).all(axis=1)
+    return epochs[keep], values[keep], columns
+
+
+def table_ends(folder, province):
+    """
+    First and last epoch of the valid rows of a province table, and the epoch of its last
+    present row, after which rows may still be replaced (see storage.append_table).
+    """
+    index = coverage_index.load(folder, province)
+    span = index.span() or (None, None)
+    present = index.span(valid=False) or (None, None)
+    return span[0], span[1], present[1]
+
+
+def read_grid(folder, provinces, time, workers=8):
+    """Filtered tables of the provinces aligned on the hourly `time` axis, read in parallel per province."""
+    features = list(storage.read_records(folder, provinces[0]).dtype.names[1:])
+    values = np.full((len(time), len(provinces), len(features)), np.nan, dtype=np.float32)
+
+    def fill(p):
+        # each province fills its own slice of the array
+        t, v, _ = read_province(folder, provinces[p], since=time[0] - 1, columns=features)
+        on_grid = (t <= time[-1]) & ((t - time[0]) % 3600 == 0)
+        values[(t[on_grid] - time[0]) // 3600, p] = v[on_grid]
+
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(fill, range(len(provinces))))
+    return values, features
+
+
+def interpolate(values):
+    """
+    Linear interpolation along the first (time) axis of the NaN of `values`, holding the
+    nearest value before the first and after the last valid value of each series.
+    Series without any valid value stay NaN.
+    """
+    n = len(values)
+    valid = ~np.isnan(values)
+    idx = np.broadcast_to(np.arange(n).reshape((n,) + (1,) * (values.ndim - 1)), values.shape)
+    prev = np.maximum.accumulate(np.where(valid, idx, -1), axis=0)
+    next_ = np.minimum.accumulate(np.where(valid, idx, n)[::-1], axis=0)[::-1]
+    prev, next_ = np.where(prev < 0, next_, prev), np.where(next_ >= n, prev, next_)
+    prev, next_ = prev.clip(0, n - 1), next_.clip(0, n - 1)
+
+    v_prev = np.take_along_axis(values, prev, axis=0)
+    v_next = np.take_along_axis(values, next_, axis=0)
+    span = next_ - prev
+    weight = np.where(span > 0, (idx - prev) / np.maximum(span, 1), 0)
+    return np.where(valid, values, v_prev + weight * (v_next - v_prev)).astype(values.dtype)
+
+
+def last_valid(values, chunk=168):
+    """
+    Row of the last valid value of each series of a (time, ...) array, -1 if it has none,
+    scanning back from the end by chunks of hours so that recent values are found quickly.
+    """
+    last = np.full(values.shape[1:], -1)
+    end = len(values)
+    while end > 0 and (last < 0).any():
+        a = max(end - chunk, 0)
+        valid = ~np.isnan(values[a:end])
+        found = valid.any(axis=0) & (last < 0)
+        last[found] = (end - 1 - np.argmax(valid[::-1], axis=0))[found]
+        end = a
+    return last
+
+
+def update_interpolated(folder, cleaned, start):
+    """
+    Interpolate the hours of the cleaned cube from row `start` on into the cube saved in `folder`.
+    The values of a series up to its last valid value before `start` are final, the hours
+    from the earliest of these boundaries on are interpolated again and rewritten.
+    """
+    boundary = last_valid(cleaned.values[:start]) if start else None
+    if boundary is not None and os.path.exists(os.path.join(folder, "meta.json")):
+        new_values = ~np.isnan(cleaned.values[start:]).all(axis=0)
+        if ((boundary < 0) & new_values).any():     # a first value, the backfill before it changes
+            a = 0
+        else:
+            a = int(boundary[boundary >= 0].min()) if (boundary >= 0).any() else start
+    else:
+        a = 0
+
+    window = interpolate(np.asarray(cleaned.values[a:]))
+    if a:
+        old = storage.Cube.load(folder)
+        rows = np.arange(a, start).reshape(-1, 1, 1)
+        window[:start - a] = np.where(rows <= boundary, old.values[a:start], window[:start - a])
+        del old
+    storage.Cube(cleaned.time[a:], cleaned.provinces, cleaned.features, window).save_at(folder, a)
+    return storage.Cube.load(folder)
+
+
+@metrics.timed("clean_seconds")
+def clean(region_folder="vietnam", src="data", incremental=True, workers=8):
+    """
+    Clean the weather and air quality of a region into cleaned and interpolated cubes
+    and return {(kind, source): cube}. With `incremental`, only the hours after the last
+    cleaned hour are read and processed, and the saved cubes are extended.
+    """
+    provinces = pd.read_csv(src + "/region/" + region_folder + "/cities.csv")["id"].to_numpy()
+    folders = {(kind, source): cube_folder(region_folder, kind + "/" + source, src)
+               for kind in ["cleaned", "interpolated"] for source in SOURCES}
+    ends = {source: np.array([table_ends(src + "/" + source, i) for i in provinces], dtype=float).T
+            for source in SOURCES}
+    first = int(max(np.nanmin(starts) for starts, _, _ in ends.values()))
+    last = int(min(np.nanmax(stops) for _, stops, _ in ends.values()))
+
+    # rows may still be appended or replaced after the last present hour of a table at the previous run,
+    # the hours from the earliest of these are processed again
+    n = 0
+    if incremental and all(os.path.exists(os.path.join(folder, "meta.json")) for folder in folders.values()):
+        cubes = {key: storage.Cube.load(folder) for key, folder in folders.items()}
+        if all(np.array_equal(cube.provinces, provinces) and len(cube.time) and cube.time[0] == first
+               and len(cube.time) == len(cubes["cleaned", "weather"].time) for cube in cubes.values()):
+            previous = min(np.nanmin(np.load(os.path.join(folders["cleaned", source], "ends.npy"))) for source in SOURCES)
+            n = int(min(len(cubes["cleaned", "weather"].time), max(0, (previous - first) // 3600 + 1)))
+        del cubes
+    time = np.arange(first + n * 3600, last + 1, 3600, dtype=np.int64)
+    if n and not len(time):
+        print("Cleaned data is up to date")
+        return {key: storage.Cube.load(folder) for key, folder in folders.items()}
+
+    grids = {source: read_grid(src + "/" + source, provinces, time, workers) for source in SOURCES}
+    present = np.logical_and.reduce([~np.isnan(values).any(axis=2) for values, _ in grids.values()])
+    cubes = {}
+    for source, (values, features) in grids.items():
+        values[~present] = np.nan
+        storage.Cube(time, provinces, features, values).save_at(folders["cleaned", source], n)
+        np.save(os.path.join(folders["cleaned", source], "ends.npy"), ends[source][2])
+        cubes["cleaned", source] = storage.Cube.load(folders["cleaned", source])
+        cubes["interpolated", source] = update_interpolated(folders["interpolated", source], cubes["cleaned", source], n)
+    print(f"Cleaned {len(time)} hours")
+    return cubes
+
+
+def complete_hours(*cubes):
+    """Mask of the hours where every province has a value in every cube."""
+    return np.logical_and.reduce([~np.isnan(np.asarray(cube.values)).any(axis=(1, 2)) for cube in cubes])
+
+
+def dropped(cleaned):
+    """{source: cube} of the cleaned cubes restricted to their complete hours."""
+    mask = complete_hours(*cleaned.values())
+    return {source: storage.Cube(cube.time[mask], cube.provinces, cube.features, cube.values[mask])
+            for source, cube in cleaned.items()}
+
+
+def to_frame(cube, names):
+    """Cube as the (time, province name) indexed dataframe of the notebooks, without missing rows."""
+    values = np.asarray(cube.values).reshape(-1, len(cube.features))
+    index = pd.MultiIndex.from_product([cube.time_index, [names[i] for i in cube.provinces]], names=["time", "province"])
+    df = pd.DataFrame(values, index=index, columns=cube.features)
+    return df[~np.isnan(values).any(axis=1)].sort_index()
+
+
+def export_csv(cubes, region_folder="vietnam", src="data"):
+    """Write the cleaned_*, dropped_* and interpolated_* CSV files read by the notebooks."""
+    cities = pd.read_csv(src + "/region/" + region_folder + "/cities.csv")
+    names = dict(zip(cities["id"], cities["admin_name"]))
+    kinds = {"cleaned": {source: cubes["cleaned", source] for source in SOURCES},
+             "interpolated": {source: cubes["interpolated", source] for source in SOURCES}}
+    kinds["dropped"] = dropped(kinds["cleaned"])
+    for kind, by_source in kinds.items():
+        for source, cube in by_source.items():
+            to_frame(cube, names).to_csv(f"{src}/region/{region_folder}/{kind}_{SOURCES[source]}.csv")
+
+
+if __name__ == "__main__":
+    export_csv(clean())
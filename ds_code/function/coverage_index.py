@@ -0,0 +1,176 @@
+import os
+import numpy as np
+import pandas as pd
+from threading import Lock
+from utils import epoch_runs, intersect_runs
+import storage
+
+# Coverage index of the stored tables, one coverage/<name>.npz per table of a folder:
+# - flags: uint8 per table row, MISSING if a value is NaN, NEGATIVE if a value is negative,
+# - present: (first, last) epochs of the runs of consecutive hours without missing value,
+# - valid: the same for the hours without missing or negative value,
+# - last: epoch of the last indexed row, so that appended rows extend the index.
+MISSING = 1
+NEGATIVE = 2
+INDEX_DIR = "coverage"
+_locks = {}
+_locks_lock = Lock()
+
+
+def index_path(folder, name):
+    return os.path.join(folder, INDEX_DIR, f"{name}.npz")
+
+
+class Coverage:
+    """Row flags and runs of present and valid hours of one table."""
+    def __init__(self, flags, present, valid, last):
+        self.flags = flags
+        self.present = present
+        self.valid = valid
+        self.last = last
+
+    @classmethod
+    def build(cls, epochs, values):
+        flags = np.where(np.isnan(values).any(axis=1), MISSING, 0).astype(np.uint8)
+        flags |= np.where((values < 0).any(axis=1), NEGATIVE, 0).astype(np.uint8)
+        return cls(flags, epoch_runs(epochs[flags & MISSING == 0]), epoch_runs(epochs[flags == 0]),
+                   int(epochs[-1]) if len(epochs) else None)
+
+    def extend(self, epochs, values):
+        """Coverage with the rows appended after the indexed ones."""
+        new = Coverage.build(epochs, values)
+        runs = [_join(self.present, new.present), _join(self.valid, new.valid)]
+        return Coverage(np.concatenate((self.flags, new.flags)), *runs, new.last if new.last is not None else self.last)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        last = np.array([-1 if self.last is None else self.last], dtype=np.int64)
+        storage._replace(path, lambda tmp_path: _savez(tmp_path, flags=self.flags, present=self.present,
+                                                        valid=self.valid, last=last))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            last = int(f["last"][0])
+            return cls(f["flags"], f["present"], f["valid"], None if last < 0 else last)
+
+    def trim(self):
+        """
+        Coverage without the rows after the last present one, as an empty tail of a table
+        is replaced by the rows appended later (see storage.append_table).
+        """
+        present = np.flatnonzero(self.flags & MISSING == 0)
+        if not len(present):
+            return Coverage(self.flags[:0], self.present, self.valid, None)
+        return Coverage(self.flags[:present[-1] + 1], self.present, self.valid, int(self.present[-1, 1]))
+
+    @property
+    def rows(self):
+        return len(self.flags)
+
+    def span(self, valid=True):
+        """(first, last) epoch of the present or valid hours, None if there is none."""
+        runs = self.valid if valid else self.present
+        return (int(runs[0, 0]), int(runs[-1, 1])) if len(runs) else None
+
+
+def _savez(path, **arrays):
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def _join(a, b, step=3600):
+    """Concatenate runs, merging the last run of `a` with the first of `b` when they are consecutive."""
+    if len(a) and len(b) and b[0, 0] == a[-1, 1] + step:
+        b = b.copy()
+        b[0, 0] = a[-1, 0]
+        a = a[:-1]
+    return np.concatenate((a, b)).reshape(-1, 2)
+
+
+def _lock(path):
+    with _locks_lock:
+        return _locks.setdefault(path, Lock())
+
+
+def update(folder, name):
+    """
+    Bring the coverage index of a table up to date and return it. Only the rows appended
+    since the last update are read when the indexed rows are unchanged, otherwise
+    the index is built again.
+    """
+    path = index_path(folder, name)
+    with _lock(path):
+        epochs, values, _ = storage.read_arrays(folder, name)
+        coverage = Coverage.load(path) if os.path.exists(path) else None
+        if coverage is not None and coverage.rows and coverage.flags[-1] & MISSING:
+            coverage = coverage.trim()
+        n = coverage.rows if coverage is not None else 0
+        if coverage is not None and n <= len(epochs) and (n == 0 or epochs[n - 1] == coverage.last):
+            if n == len(epochs):
+                return coverage
+            coverage = coverage.extend(epochs[n:], values[n:])
+        else:
+            coverage = Coverage.build(epochs, values)
+        coverage.save(path)
+        return coverage
+
+
+def load(folder, name):
+    """Coverage index of a table, updated first if the table changed since it was saved."""
+    path = index_path(folder, name)
+    table = storage.find_table(folder, name)
+    if table is None:
+        raise FileNotFoundError(storage.table_path(folder, name))
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(table):
+        return Coverage.load(path)
+    return update(folder, name)
+
+
+def common_runs(name, data_dir="data", weather="present", air_quality="valid"):
+    """
+    Runs of the hours covered by both the weather and the air quality tables of a city,
+    by default the present weather and the valid air quality hours used for training.
+    """
+    w = load(data_dir + "/weather", name)
+    a = load(data_dir + "/air_quality", name)
+    return intersect_runs(getattr(w, weather), getattr(a, air_quality))
+
+
+def count_windows(runs, window_size=4, target_size="same", target_runs=None, step=3600):
+    """
+    Number of windows of `window_size` hours inside `runs`. With target_size="one" and
+    `target_runs`, only the windows whose last hour lies in `target_runs` are counted.
+    """
+    runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+    if target_size == "one" and target_runs is not None:
+        ends = runs + np.array([(window_size - 1) * step, 0])
+        runs = intersect_runs(ends[ends[:, 0] <= ends[:, 1]], target_runs)
+        window_size = 1
+    return int(np.maximum((runs[:, 1] - runs[:, 0]) // step + 2 - window_size, 0).sum())
+
+
+def index_folder(folder, names=None):
+    """Update the coverage index of every table of a folder, return {name: coverage}."""
+    if names is None:
+        names = sorted({os.path.splitext(entry)[0] for entry in os.listdir(folder)
+                        if entry.endswith(tuple("." + fmt for fmt in storage.FORMATS))})
+    return {name: update(folder, name) for name in names}
+
+
+def summary(folder):
+    """Dataframe of the rows, flagged rows, runs and span of the valid hours of every table of a folder."""
+    rows = {}
+    for name, coverage in index_folder(folder).items():
+        span = coverage.span()
+        rows[name] = {"rows": coverage.rows, "missing": int((coverage.flags & MISSING != 0).sum()),
+                      "negative": int((coverage.flags & NEGATIVE != 0).sum()),
+                      "present_runs": len(coverage.present), "valid_runs": len(coverage.valid),
+                      "first": pd.Timestamp(span[0], unit="s") if span else None,
+                      "last": pd.Timestamp(span[1], unit="s") if span else None}
+    return pd.DataFrame.from_dict(rows, orient="index")
+
+
+if __name__ == "__main__":
+    for folder in ["data/weather", "data/air_quality"]:
+        print(summary(folder))
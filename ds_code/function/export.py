@@ -0,0 +1,65 @@
+import joblib
+import torch
+from torch import nn
+from models import *
+
+# Exported models are frozen TorchScript graphs taking raw (unscaled) inputs and
+# returning predictions in original units, their scalers are stored as buffers.
+
+
+class ExportedGRU(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, X, init_data):
+        return self.model((X, init_data), rescale=True)[:, -1]
+
+
+class ExportedConvLSTM(nn.Module):
+    def __init__(self, model, features_scaler, target_scaler, n_provinces=63):
+        super().__init__()
+        self.model = model
+        self.n_provinces = n_provinces
+        self.register_buffer("features_mean", torch.tensor(features_scaler.mean_).float())
+        self.register_buffer("features_scale", torch.tensor(features_scaler.scale_).float())
+        self.register_buffer("target_mean", torch.tensor(target_scaler.mean_).float())
+        self.register_buffer("target_scale", torch.tensor(target_scaler.scale_).float())
+
+    def forward(self, X):
+        X = self.model((X - self.features_mean) / self.features_scale)
+        X = X.view(X.shape[0], self.n_provinces, -1) * self.target_scale + self.target_mean
+        return X.flatten(1)
+
+
+def freeze(module, example_inputs):
+    """Trace a module in eval mode and freeze its weights into the TorchScript graph."""
+    module.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example_inputs)
+    return torch.jit.freeze(traced)
+
+
+def export_gru(model_dir="models/gru.pth", path="models/gru.pt"):
+    model = torch.load(model_dir, map_location="cpu", weights_only=False)
+    example_inputs = (torch.zeros(2, model.seq_len, model.input_size), torch.zeros(2, 3))
+    torch.jit.save(freeze(ExportedGRU(model), example_inputs), path)
+
+
+def export_conv_lstm(model_dir="models/conv_lstm.pth", path="models/conv_lstm.pt",
+                     scaler_dirs=("models/weather_scaler.pickle", "models/air_scaler.pickle"), sequence_length=3):
+    features_scaler, target_scaler = (joblib.load(scaler_dir) for scaler_dir in scaler_dirs)
+    model = ConvLSTMTimeSeries(
+        input_dim = 63,
+        hidden_dim = [256],
+        input_width = features_scaler.n_features_in_,
+        output_width = target_scaler.n_features_in_
+    )
+    model.load_state_dict(torch.load(model_dir, map_location="cpu", weights_only=True))
+    example_inputs = (torch.zeros(2, sequence_length, 63, 1, features_scaler.n_features_in_),)
+    torch.jit.save(freeze(ExportedConvLSTM(model, features_scaler, target_scaler), example_inputs), path)
+
+
+if __name__ == "__main__":
+    export_gru()
+    export_conv_lstm()
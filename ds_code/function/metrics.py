@@ -0,0 +1,149 @@
+import os
+import json
+from time import perf_counter, time
+from threading import Lock
+from functools import wraps
+
+# Process-wide timers and counters. Metrics are off unless DS_METRICS=1 is set or
+# enable() is called; while off, timer() returns a shared no-op context manager
+# and the other hooks return immediately.
+
+_enabled = os.environ.get("DS_METRICS", "0") not in ("", "0")
+_lock = Lock()
+_metrics = {}                       # (name, labels) -> [count, sum, min, max]
+_kinds = {}                         # name -> "counter" or "summary"
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def enabled():
+    return _enabled
+
+
+def _record(kind, name, value, labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _kinds[name] = kind
+        stats = _metrics.get(key)
+        if stats is None:
+            _metrics[key] = [1, value, value, value]
+        else:
+            stats[0] += 1
+            stats[1] += value
+            stats[2] = min(stats[2], value)
+            stats[3] = max(stats[3], value)
+
+
+def count(name, value=1, **labels):
+    """Add `value` to a counter."""
+    if _enabled:
+        _record("counter", name, value, labels)
+
+
+def observe(name, value, **labels):
+    """Record one observation (e.g. a duration in seconds) of a summary."""
+    if _enabled:
+        _record("summary", name, value, labels)
+
+
+class _Timer:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _record("summary", self.name, perf_counter() - self.start, self.labels)
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(name, **labels):
+    """Context manager observing the seconds spent in its block."""
+    return _Timer(name, labels) if _enabled else _NO_TIMER
+
+
+def timed(name, **labels):
+    """Decorator observing the seconds spent in each call of a function."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(name, labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """List of {name, kind, labels, count, sum, min, max} of every metric."""
+    with _lock:
+        return [{"name": name, "kind": _kinds[name], "labels": dict(labels),
+                 "count": stats[0], "sum": stats[1], "min": stats[2], "max": stats[3]}
+                for (name, labels), stats in sorted(_metrics.items())]
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+        _kinds.clear()
+
+
+def to_json_lines():
+    """One JSON object per metric, stamped with the export time."""
+    now = time()
+    return "".join(json.dumps(dict(metric, time=now)) + "\n" for metric in snapshot())
+
+
+def _escape(value):
+    """Label value with the backslashes, quotes and newlines escaped as Prometheus requires."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus():
+    """Metrics in the Prometheus text exposition format, summaries as _count and _sum."""
+    lines, typed = [], set()
+    for metric in snapshot():
+        name = metric["name"]
+        labels = ",".join(f'{k}="{_escape(v)}"' for k, v in metric["labels"].items())
+        labels = "{" + labels + "}" if labels else ""
+        if metric["kind"] == "counter":
+            if name not in typed:
+                lines.append(f"# TYPE {name}_total counter")
+            lines.append(f"{name}_total{labels} {metric['sum']:g}")
+        else:
+            if name not in typed:
+                lines.append(f"# TYPE {name} summary")
+            lines.append(f"{name}_count{labels} {metric['count']}")
+            lines.append(f"{name}_sum{labels} {metric['sum']:g}")
+        typed.add(name)
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    """Append the metrics to a .jsonl file, or write them in Prometheus format to any other path."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if path.endswith(".jsonl"):
+        with open(path, "a") as f:
+            f.write(to_json_lines())
+    else:
+        with open(path, "w") as f:
+            f.write(to_prometheus())
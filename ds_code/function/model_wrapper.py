@@ -1,18 +1,62 @@
+import os
 import joblib
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 from torch import load
-from utils import predict_window, group_data
+from utils import predict_window, group_cube
 from models import *
+import storage
+import metrics
 
 
+def add_wind_components(weather_df):
+    """Copy of a weather dataframe with the wind direction replaced by its x and y components."""
+    wind_direction = weather_df["wind_direction_10m"] / (180 / np.pi)
+    weather_df = weather_df.assign(wind_x_component=np.cos(wind_direction), wind_y_component=np.sin(wind_direction))
+    return weather_df.drop("wind_direction_10m", axis=1)
+
+
+def window_inputs(frames, init_df):
+    """
+    Window the weather dataframe of every province of `init_df` and stack the windows
+    together, with the (lat, lng, population) row of their province in `init_data`.
+    """
+    time_idxs, Xs = [], []
+    for weather_df in frames:
+        time_idx, X = predict_window(weather_df)
+        time_idxs.append(time_idx)
+        Xs.append(X)
+    init_data = np.repeat(init_df.to_numpy()[:, :3], [len(X) for X in Xs], axis=0)
+    return time_idxs, np.concatenate(Xs), init_data
+
+
+def cube_features(cube):
+    """
+    Province ids sorted by name, and the weather of a cube in that order as an array of
+    shape (provinces, time, features), the wind direction replaced by its x and y components.
+    """
+    cities_df = pd.read_csv("data/region/vietnam/cities.csv").set_index("id")
+    names = cities_df.loc[cube.provinces, "admin_name"].to_numpy()
+    ids = cube.provinces[np.argsort(names, kind="stable")]
+    
+    features = [f for f in cube.features if f != "wind_direction_10m"]
+    weather = cube.take(ids, features + ["wind_direction_10m"]).transpose(1, 0, 2)
+    wind_direction = weather[:, :, -1:] / (180 / np.pi)
+    return ids, np.concatenate((weather[:, :, :-1], np.cos(wind_direction), np.sin(wind_direction)), axis=-1)
+
 
 class ModelWrapper:
     """Wrapper for convenient large scale prediction with models."""
-    def __init__(self, model_dir, output_dir):
+    def __init__(self, model_dir, output_dir, batch_size=None):
+        start = perf_counter()
         self.model = self.load_model(model_dir)
+        self.timings = {"load": perf_counter() - start}
         self.output_dir = output_dir
         self.input_dir = "forecast/weather"
+        self.batch_size = batch_size
         
     def load_model(self, model_dir):
         pass
@@ -22,64 +66,142 @@ class ModelWrapper:
     
     def get_dataframe(self, i):
         pass
+    
+    def get_inputs(self, init_df):
+        """Stacked windows of every province, see `window_inputs`."""
+        return window_inputs([self.get_dataframe(i) for i in init_df.index], init_df)
+    
+    def forward(self, inp, **kwargs):
+        """One forward pass of the model, timed in the metrics."""
+        with metrics.timer("model_forward_seconds", model=type(self).__name__):
+            return self.model.predict(inp, **kwargs)
+    
+    def predict(self, X, init_data):
+        """Predict the stacked windows in batches of at most `batch_size` samples."""
+        step = self.batch_size or max(len(X), 1)
+        outputs = [self.forward(self.input_process(X[start:start + step], init_data[start:start + step]))
+                   for start in range(0, len(X), step)]
+        return np.concatenate(outputs) if outputs else np.empty((0, 6))
+    
+    def store(self, i, time_idx, output):
+        forecast_df = pd.DataFrame(output, index=time_idx.rename("time"), 
+                                   columns=["co", "no2", "o3", "so2", "pm2_5", "pm10"]).apply(lambda x: round(x, 2))
+        storage.write_table(forecast_df.reset_index(), self.output_dir, i)
+        
+    def store_all(self, ids, time_idxs, output):
+        """Split the stacked output back into provinces and store each of them."""
+        position = 0
+        for i, time_idx in zip(ids, time_idxs):
+            self.store(i, time_idx.strftime("%Y-%m-%dT%H:%M"), output[position:position + len(time_idx)])
+            position += len(time_idx)
+        
+    def report_timings(self):
+        for stage, seconds in self.timings.items():
+            metrics.observe("forecast_stage_seconds", seconds, model=type(self).__name__, stage=stage)
+        print(f"{type(self).__name__}: " + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in self.timings.items()))
         
     def forecast(self, extra_dir):
         """Method for predicting and storing the result for further visualization."""
+        start = perf_counter()
         init_df = pd.read_csv(extra_dir).set_index("id")
-        for i in init_df.index:
-            time_idx, X = predict_window(self.get_dataframe(i))
-            init_data = init_df.loc[i]
-            inp = self.input_process(X, init_data)
-            output = self.model.predict(inp)
-            forecast_df = pd.DataFrame(output, index=time_idx.strftime("%Y-%m-%dT%H:%M"), 
-                                       columns=["co", "no2", "o3", "so2", "pm2_5", "pm10"]).apply(lambda x: round(x, 2))
-            forecast_df.to_csv(f"{self.output_dir}/{i}.csv")
+        time_idxs, X, init_data = self.get_inputs(init_df)
+        self.timings["window"] = perf_counter() - start
+        
+        start = perf_counter()
+        output = self.predict(X, init_data)
+        self.timings["predict"] = perf_counter() - start
+        
+        start = perf_counter()
+        self.store_all(init_df.index, time_idxs, output)
+        self.timings["store"] = perf_counter() - start
+        self.report_timings()
+            
+def set_n_jobs(estimator, n_jobs):
+    """Set n_jobs on a fitted estimator and on the fitted estimators nested in it."""
+    if hasattr(estimator, "n_jobs"):
+        estimator.n_jobs = n_jobs
+    for _, step in getattr(estimator, "steps", []):
+        set_n_jobs(step, n_jobs)
+    if hasattr(estimator, "regressor_"):
+        set_n_jobs(estimator.regressor_, n_jobs)
             
 class RandomForestPredictor(ModelWrapper):
-    def __init__(self):
-        super().__init__("models/random_forest.pkl", "forecast/aqi/random_forest")
+    def __init__(self, n_jobs=-1, parallel="trees", batch_size=None):
+        """
+        parallel="trees" lets the forest spread its trees over `n_jobs` threads,
+        parallel="rows" predicts row blocks of `batch_size` samples on `n_jobs` threads.
+        Threads rather than processes: the tree traversal of sklearn releases the GIL,
+        and worker processes would each need a copy of the pickled forest.
+        """
+        self.n_jobs = n_jobs
+        self.parallel = parallel
+        super().__init__("models/random_forest.pkl", "forecast/aqi/random_forest", batch_size)
         
     def load_model(self, model_dir):
-        return joblib.load(model_dir)    
+        model = joblib.load(model_dir)
+        set_n_jobs(model, self.n_jobs if self.parallel == "trees" else 1)
+        return model
+    
+    def predict(self, X, init_data):
+        if self.parallel != "rows":
+            return super().predict(X, init_data)
+        if len(X) == 0:
+            return np.empty((0, 6))
+        inp = self.input_process(X, init_data)
+        n_jobs = self.n_jobs if self.n_jobs > 0 else os.cpu_count()
+        step = self.batch_size or -(-len(inp) // n_jobs)
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            outputs = list(pool.map(self.forward, [inp[start:start + step] for start in range(0, len(inp), step)]))
+        return np.concatenate(outputs) if outputs else np.empty((0, 6))
     
     def get_dataframe(self, i):
-        return pd.read_csv(f"{self.input_dir}/{i}.csv")
+        return storage.read_table(self.input_dir, i)
         
     def input_process(self, X, init_data):
         m = X.shape[0]
-        lat = np.full((m, 1), init_data[0])
-        lng = np.full((m, 1), init_data[1])
-        population = np.full((m, 1), init_data[2])
-        init_data = np.hstack((lat, lng, population))
         return np.hstack((X.reshape(m, -1), init_data))
     
 class GRUPredictor(ModelWrapper):
-    def __init__(self):
-        super().__init__("models/gru.pth", "forecast/aqi/gru")
+    def __init__(self, batch_size=4096, num_threads=None, backend="eager", quantize=False):
+        """
+        backend="torchscript" runs the graph exported by export.py instead of the pickled module.
+        quantize=True runs the GRU and linear layers with int8 dynamic quantization.
+        """
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.quantize = quantize
+        model_dir = "models/gru.pt" if backend == "torchscript" else "models/gru.pth"
+        super().__init__(model_dir, "forecast/aqi/gru", batch_size)
         
     def load_model(self, model_dir):
-        return load(model_dir, map_location="cpu")
+        if model_dir.endswith(".pt"):
+            return ScriptedModel(model_dir)
+        model = load(model_dir, map_location="cpu", weights_only=False)
+        return quantize_dynamic(model) if self.quantize else model
     
     def get_dataframe(self, i):
-        weather_df = pd.read_csv(f"{self.input_dir}/{i}.csv")
-        weather_df["wind_x_component"] = np.cos(weather_df["wind_direction_10m"] / (180 / np.pi))
-        weather_df["wind_y_component"] = np.sin(weather_df["wind_direction_10m"] / (180 / np.pi))
-        weather_df.drop("wind_direction_10m", axis=1, inplace=True)
-        return weather_df
+        return add_wind_components(storage.read_table(self.input_dir, i))
     
     def input_process(self, X, init_data):
-        m = X.shape[0]
-        lat = np.full((m, 1), init_data[0])
-        lng = np.full((m, 1), init_data[1])
-        population = np.full((m, 1), init_data[2])
-        init_data = np.hstack((lat, lng, population))
+        # init_data holds one row per window, so provinces can share a batch
         return X, init_data
     
 class ConvLSTMPredictor(ModelWrapper):
-    def __init__(self):
-        super().__init__("models/conv_lstm.pth", "forecast/aqi/conv_lstm")
+    def __init__(self, batch_size=None, num_threads=None, backend="eager", quantize=False):
+        """
+        backend="torchscript" runs the graph exported by export.py, which embeds the scalers.
+        quantize=True runs the linear head with int8 dynamic quantization.
+        """
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.backend = backend
+        self.quantize = quantize
+        model_dir = "models/conv_lstm.pt" if backend == "torchscript" else "models/conv_lstm.pth"
+        super().__init__(model_dir, "forecast/aqi/conv_lstm", batch_size)
 
     def load_model(self, model_dir):
+        if model_dir.endswith(".pt"):
+            return ScriptedModel(model_dir)
         conv_lstm = ConvLSTMTimeSeries(
             input_dim = 63,
             hidden_dim = [256],
@@ -87,52 +209,135 @@ class ConvLSTMPredictor(ModelWrapper):
             output_width = 6
         )
         conv_lstm.load_state_dict(torch.load(model_dir, map_location="cpu", weights_only=True))
-        return conv_lstm
-
-    def get_dataframe(self):
-        weather_df = group_data('vietnam', 'weather' , '', to_csv=False, src = 'forecast')
-        self.time_index = weather_df.index
-        weather_df = weather_df.stack(level=0).reset_index()
-        weather_df.rename(columns={'level_1': 'location'}, inplace=True)
-        weather_df[['province', 'country']] = weather_df['location'].str.split(',', expand=True)
-        weather_df = weather_df.drop(columns=['location'])
-
-        cities_df = pd.read_csv("data/region/vietnam/cities.csv")
-        weather_df = weather_df.merge(cities_df[['city', 'admin_name']], right_on='city', left_on='province', how='left')
-        weather_df.drop(columns=['country', 'city', 'province'], inplace=True)
-        weather_df.rename(columns={'admin_name': 'province'}, inplace=True)
-        weather_df['time'] = weather_df['time'].astype('datetime64[s]')
-        weather_df = weather_df.set_index(['time', 'province']).sort_index()
-
-        weather_df["wind_x_component"] = np.cos(weather_df["wind_direction_10m"] / (180 / np.pi))
-        weather_df["wind_y_component"] = np.sin(weather_df["wind_direction_10m"] / (180 / np.pi))
-        weather_df.drop(columns='wind_direction_10m', inplace=True)
-        weather_df = weather_df.reset_index().sort_values(by=['province', 'time'])
-        self.province = weather_df['province']
-        return weather_df
+        return quantize_dynamic(conv_lstm) if self.quantize else conv_lstm
 
-    def forecast(self):
-        custom_scaler = joblib.load('models/weather_scaler.pickle'), joblib.load('models/air_scaler.pickle')
-        weather_df = self.get_dataframe()
-        predict_dataset =  TimeSeries3DDataset(None, weather_df.drop(columns=['province', 'time']), 63, 3, custom_scaler=custom_scaler, predict=True)
-        predict_dataloader = DataLoader(predict_dataset, batch_size=1, shuffle=False, num_workers = 0, pin_memory=True)
+    def get_features(self, cube):
+        """Weather of a cube as an array of shape (provinces, time, features), provinces sorted by name."""
+        self.ids, weather = cube_features(cube)
+        return weather
+
+    def get_cube(self):
+        """Forecast weather as an array of shape (provinces, time, features), provinces sorted by name."""
+        cube = group_cube('vietnam', 'weather', src='forecast')
+        self.time_index = cube.time_index
+        return self.get_features(cube)
+
+    def scalers(self):
+        """Weather and air scalers, loaded on the first call and kept with the model."""
+        if getattr(self, "_scalers", None) is None:
+            if self.backend == "torchscript":
+                # scaling happens inside the exported graph
+                self._scalers = preprocessing.FunctionTransformer(), preprocessing.FunctionTransformer()
+            else:
+                self._scalers = joblib.load('models/weather_scaler.pickle'), joblib.load('models/air_scaler.pickle')
+        return self._scalers
+
+    def predict_weather(self, weather):
+        """Predict pollutants of shape (provinces, time, 6) from weather of shape (provinces, time, features)."""
+        predict_dataset =  TimeSeries3DDataset(None, weather, 63, 3, custom_scaler=self.scalers(), predict=True)
+        step = self.batch_size or len(predict_dataset)
 
         with torch.no_grad():
+            # every hour of a batch goes through the ConvLSTM in the same forward pass
             outputs = []
-            for X in predict_dataloader:
-                output = self.model.predict(X, numpy_output=False).squeeze()
-                output = output.view(63, 1, 6)
-                outputs.append(output)
-
-            stacked_outputs = torch.cat(outputs, dim=1)
-            original_outputs = stacked_outputs.view(-1, 6)
-            original_outputs = predict_dataset.target_scaler.inverse_transform(original_outputs)
-        length, width = original_outputs.shape
-        ids = pd.read_csv('data/region/vietnam/cities.csv').set_index("admin_name").loc[self.province.sort_index()[:63]]['id']
-        for i in range(63):
-            forecast_df = pd.DataFrame(original_outputs[i*length//63:(i+1)*length//63], index=self.time_index, 
-                                       columns=["co", "no2", "o3", "so2", "pm2_5", "pm10"]).apply(lambda x: round(x, 2))
-            forecast_df.to_csv(f"{self.output_dir}/{ids[i]}.csv")
+            for start in range(0, len(predict_dataset), step):
+                output = self.forward(predict_dataset.windows(start, start + step), numpy_output=False)
+                outputs.append(output.view(-1, 63, 6))
+
+            stacked_outputs = torch.cat(outputs).permute(1, 0, 2)
+            original_outputs = stacked_outputs.reshape(-1, 6)
+            original_outputs = np.asarray(predict_dataset.target_scaler.inverse_transform(original_outputs))
+        return original_outputs.reshape(63, -1, 6)
+
+    def predict_stream(self, weather, time, ids, max_streams=4, max_steps=2):
+        """
+        `predict_weather` for a forecast overlapping one seen before for the same provinces.
+        The inputs and outputs of recent calls are cached under (province ids, last hour).
+        An output only depends on the window of the last `sequence_length` hours (mirror
+        padded for the first hours), so the outputs of the windows before the first hour that
+        changed since a cached call are kept, and only the hours from there on are predicted:
+        up to `max_steps` hours one cell step each through a WindowStream primed with the hours
+        before, more in one windowed pass. The TorchScript backend predicts in full.
+        """
+        features_scaler, target_scaler = self.scalers()
+        if self.backend == "torchscript":
+            return self.predict_weather(weather)
+        if not hasattr(self, "streams"):
+            self.streams = OrderedDict()
+        time = np.asarray(time, dtype=np.int64)
+        weather = np.array(weather)
+        ids = tuple(int(i) for i in ids)
+        n, length = len(time), WindowStream(self.model).sequence_length
+
+        # the cached call whose outputs cover the most hours of this one
+        best = None
+        for key, cached in self.streams.items():
+            reuse = self._reusable(cached, weather, time, length) if key[0] == ids else None
+            if reuse is not None and (best is None or reuse[2] - reuse[1] > best[3] - best[2]):
+                best = (key,) + reuse
+        if best is None or best[3] < length - 1:
+            outputs = self.predict_weather(weather)
+        else:
+            key, offset, lo, f = best
+            cached = self.streams.pop(key)
+            parts = []
+            if lo:
+                # the first windows are mirror padded, unlike the same hours inside the cached call
+                parts.append(self.predict_weather(weather[:, :length - 1])[:, :lo])
+            parts.append(cached["outputs"][:, offset + lo:offset + f])
+            if f < n and n - f <= max_steps:
+                stream = WindowStream(self.model)
+                with torch.no_grad():
+                    stream.extend(self._scaled_hours(weather[:, f - length + 1:f], features_scaler))
+                    new = stream.extend(self._scaled_hours(weather[:, f:], features_scaler))
+                parts.append(np.asarray(target_scaler.inverse_transform(new.view(-1, 6))).reshape(-1, 63, 6).transpose(1, 0, 2))
+            elif f < n:
+                # the windows of the hours before f hold real hours, not padding
+                parts.append(self.predict_weather(weather[:, f - length + 1:])[:, length - 1:])
+            outputs = np.concatenate(parts, axis=1)
+            metrics.count("stream_hours", n - f)
+
+        self.streams[(ids, int(time[-1]))] = {"time": time, "weather": weather, "outputs": outputs}
+        while len(self.streams) > max_streams:
+            self.streams.popitem(last=False)
+        return outputs
+
+    @staticmethod
+    def _reusable(cached, weather, time, length):
+        """
+        (offset, lo, f) when the hours [lo, f) of a new call can take the outputs of the hours
+        [offset + lo, offset + f) of a cached call, None when the calls do not overlap.
+        """
+        offset = (int(time[0]) - int(cached["time"][0])) // 3600
+        m = min(len(cached["time"]) - offset, len(time))
+        if offset < 0 or m <= 0 or not np.array_equal(cached["time"][offset:offset + m], time[:m]):
+            return None
+        a, b = cached["weather"][:, offset:offset + m], weather[:, :m]
+        same = ((a == b) | (np.isnan(a) & np.isnan(b))).all(axis=(0, 2))
+        # hour r keeps its output while the hours r - length + 1 ... r are unchanged
+        f = int(np.argmin(same)) if not same.all() else m
+        lo = 0 if offset == 0 else min(length - 1, f)
+        return offset, lo, f
+
+    @staticmethod
+    def _scaled_hours(weather, features_scaler):
+        """Hours of a (provinces, time, features) array scaled as the model inputs, shape (time, provinces, 1, features)."""
+        scaled = features_scaler.transform(weather.reshape(-1, weather.shape[-1])).reshape(weather.shape)
+        return torch.tensor(scaled).float().permute(1, 0, 2).unsqueeze(2)
+
+    def forecast(self):
+        start = perf_counter()
+        weather = self.get_cube()
+        self.timings["window"] = perf_counter() - start
+        
+        start = perf_counter()
+        original_outputs = self.predict_weather(weather)
+        self.timings["predict"] = perf_counter() - start
+        
+        start = perf_counter()
+        self.store_all(self.ids, [self.time_index] * len(self.ids), original_outputs.reshape(-1, 6))
+        self.timings["store"] = perf_counter() - start
+        self.report_timings()
             
 
 if __name__ == "__main__":
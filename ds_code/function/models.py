@@ -1,6 +1,7 @@
 from torch import nn, Tensor
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from sklearn import preprocessing
+import numpy as np
 import torch
 
 class CustomGRU(nn.Module):
@@ -30,18 +31,28 @@ class CustomGRU(nn.Module):
         # Final fully connected layer
         self.linear = nn.Linear(64, output_size)
 
-    def forward(self, inp, rescale=False):
+    def forward(self, inp, rescale=False, hidden_state=None, return_state=False):
+        """
+        `hidden_state` is the list of the (1, batch, hidden) states of the three GRUs to start
+        from, by default the one computed from init_data for the first and zeros for the others.
+        With return_state=True the states after the last hour are returned with the output.
+        Windows are normalized as a whole, so the states only continue a window of the same
+        normalization, not the next overlapping window.
+        """
         X, init_data = inp
         X = self.flatten(X)
         X = self.normalize(X).reshape((-1, self.seq_len, self.input_size))
-        init_data = self.init_nn(init_data.unsqueeze(0))
-        X, _ = self.gru1(X, init_data)
-        X, _ = self.gru2(X)
-        X, _ = self.gru3(X)
+        if hidden_state is None:
+            hidden_state = [self.init_nn(init_data.unsqueeze(0)), None, None]
+        X, h1 = self.gru1(X, hidden_state[0])
+        X, h2 = self.gru2(X, hidden_state[1])
+        X, h3 = self.gru3(X, hidden_state[2])
         X = self.linear(X)
         # Rescale if needed with a standard scaler (for actual prediction)
         if rescale:
             X = self.label_scaler.inverse_transform(X)
+        if return_state:
+            return X, [h1, h2, h3]
         return X
     
     def predict(self, inp, numpy_output=True):
@@ -54,6 +65,25 @@ class CustomGRU(nn.Module):
             output = output.numpy()
         return output[:, -1]
     
+def quantize_dynamic(model):
+    """Int8 dynamic quantization of the GRU and linear layers of a model, convolutions stay float32."""
+    return torch.ao.quantization.quantize_dynamic(model, {nn.GRU, nn.Linear}, dtype=torch.qint8)
+    
+class ScriptedModel:
+    """Load an exported TorchScript model and give it the predict interface of the eager models."""
+    def __init__(self, path):
+        # graph optimizations depend on the local CPU, so they are applied at load time
+        self.module = torch.jit.optimize_for_inference(torch.jit.load(path, map_location="cpu"))
+        
+    def predict(self, inp, numpy_output=True):
+        inp = inp if isinstance(inp, tuple) else (inp,)
+        inp = tuple(torch.as_tensor(np.asarray(x), dtype=torch.float32) for x in inp)
+        with torch.inference_mode():
+            output = self.module(*inp)
+        if numpy_output:
+            output = output.numpy()
+        return output
+    
 class StandardScaler(torch.nn.Module):
     """Scaler for normalizing and revert data to original."""
     def __init__(self):
@@ -197,8 +227,8 @@ class ConvLSTM(nn.Module):
         ----------
         input_tensor: todo
             5-D Tensor either of shape (t, b, c, h, w) or (b, t, c, h, w)
-        hidden_state: todo
-            None. todo implement stateful
+        hidden_state: list of (h, c) per layer
+            States to start from, zeros by default.
 
         Returns
         -------
@@ -210,10 +240,7 @@ class ConvLSTM(nn.Module):
 
         b, _, _, h, w = input_tensor.size()
 
-        # Implement stateful ConvLSTM
-        if hidden_state is not None:
-            raise NotImplementedError()
-        else:
+        if hidden_state is None:
             # Since the init is done in forward. Can send image size here
             hidden_state = self._init_hidden(batch_size=b,
                                              image_size=(h, w))
@@ -245,6 +272,18 @@ class ConvLSTM(nn.Module):
 
         return layer_output_list, last_state_list
 
+    def step(self, input_tensor, hidden_state):
+        """
+        One time step of shape (b, c, h, w) through every layer from the per-layer (h, c)
+        states, returning the list of the new states.
+        """
+        states = []
+        for cell, (h, c) in zip(self.cell_list, hidden_state):
+            h, c = cell(input_tensor=input_tensor, cur_state=[h, c])
+            states.append((h, c))
+            input_tensor = h
+        return states
+
     def _init_hidden(self, batch_size, image_size):
         init_states = []
         for i in range(self.num_layers):
@@ -276,10 +315,13 @@ class ConvLSTMTimeSeries(nn.Module):
         self.linear = nn.Linear(hidden_dim[-1] * input_width, input_dim*output_width)
         self.flatten = nn.Flatten(1, -1)
 
-    def forward(self, X):
-        _, last_states = self.conv_lstm(X)
-        X = last_states[0][0]
-        X = self.flatten(X)
+    def forward(self, X, hidden_state=None):
+        _, last_states = self.conv_lstm(X, hidden_state)
+        return self.head(last_states[0][0])
+
+    def head(self, h):
+        """Output of the last layer hidden state h."""
+        X = self.flatten(h)
         X = self.linear(X)
 
         return X
@@ -292,32 +334,84 @@ class ConvLSTMTimeSeries(nn.Module):
             output = output.numpy()
         return output
     
+class WindowStream:
+    """
+    Windowed ConvLSTMTimeSeries inference fed one hour at a time. The (h, c) states of the
+    windows still open are kept as one batch, so a new hour costs one batched cell step
+    per layer and completes the window of the last `sequence_length` hours, whose output
+    is the one of the windowed forward pass.
+    """
+    def __init__(self, model, sequence_length=3):
+        self.model = model
+        self.sequence_length = sequence_length
+        self.states = None                  # per-layer (h, c) of the open windows, oldest first
+        self.hours = 0
+
+    def push(self, x):
+        """Feed one hour of shape (provinces, 1, features), return the output of the window it completes or None."""
+        x = x.unsqueeze(0)
+        fresh = self.model.conv_lstm._init_hidden(1, x.shape[-2:])
+        if self.states is None:
+            states = fresh
+        else:
+            states = [(torch.cat((h, h0)), torch.cat((c, c0))) for (h, c), (h0, c0) in zip(self.states, fresh)]
+        states = self.model.conv_lstm.step(x.expand(len(states[0][0]), *x.shape[1:]), states)
+        self.hours += 1
+
+        output = None
+        if self.hours >= self.sequence_length:
+            output = self.model.head(states[-1][0][:1])[0]
+            states = [(h[1:], c[1:]) for h, c in states]
+        self.states = states
+        return output
+
+    def extend(self, X):
+        """Feed hours of shape (hours, provinces, 1, features), return the stacked outputs of the completed windows."""
+        outputs = [self.push(x) for x in X]
+        outputs = [output for output in outputs if output is not None]
+        return torch.stack(outputs) if outputs else torch.empty(0, self.model.linear.out_features)
+
+
 class TimeSeries3DDataset(Dataset):
-    def __init__(self, target, features, n_provinces, sequence_length=3, custom_scaler=None, predict=False):
+    """
+    Windows of a (provinces, time, features) series, indexed by time. Integer indices
+    give one item, slices and index arrays give a whole batch gathered from one strided
+    view. `dtype` is the storage type (e.g. torch.bfloat16), batches are served as float32.
+    """
+    def __init__(self, target, features, n_provinces, sequence_length=3, custom_scaler=None, predict=False, dtype=torch.float32):
+        # dataframes are in long form sorted by province then time, arrays are (provinces, time, columns)
+        features = self._to_3d(features, n_provinces)
         if custom_scaler:
             self.features_scaler, self.target_scaler = custom_scaler
         else:
+            target = self._to_3d(target, n_provinces)
             self.target_scaler = preprocessing.StandardScaler()
-            self.target_scaler.fit(target.values)
+            self.target_scaler.fit(target.reshape(-1, target.shape[-1]))
             self.features_scaler = preprocessing.StandardScaler()
-            self.features_scaler.fit(features.values)
+            self.features_scaler.fit(features.reshape(-1, features.shape[-1]))
 
-        self.features = self.features_scaler.transform(features.values)
+        self.features = self.features_scaler.transform(features.reshape(-1, features.shape[-1]))
+        self.sequence_length = sequence_length
 
-        self.X = torch.tensor(self.features.reshape(n_provinces, len(features)//n_provinces, len(features.columns))).float()
+        # mirror padding is done once, X is a view on the padded tensor
+        X = torch.tensor(self.features.reshape(features.shape)).float()
+        self.X_padded = self._mirror_padding(X, sequence_length, sequence_length - 1).to(dtype)
+        self.X = self.X_padded[:, sequence_length - 1:]
         self.predict = predict
         if self.predict:
             self.y = None
         else:
-            self.target = self.target_scaler.transform(target.values)
-            self.y = torch.tensor(self.target.reshape(n_provinces, len(target)//n_provinces, len(target.columns))).float()
+            target = self._to_3d(target, n_provinces)
+            self.target = self.target_scaler.transform(target.reshape(-1, target.shape[-1]))
+            self.y = torch.tensor(self.target.reshape(target.shape)).to(dtype)
             self.target_length = self.target.shape[-1]
 
-        self.sequence_length = sequence_length
         self.features_length = self.features.shape[-1]
     
-
-
+    @staticmethod
+    def _to_3d(data, n_provinces):
+        values = np.asarray(getattr(data, "values", data))
+        return values.reshape(n_provinces, -1, values.shape[-1])
 
     def __len__(self):
         return self.X.shape[1]
@@ -327,19 +421,69 @@ class TimeSeries3DDataset(Dataset):
         padded_x = torch.cat([mirrored_part, x], dim=1)
         return padded_x
 
-    def _get_window(self, X, i):
-        if i >= self.sequence_length - 1:
-            i_start = i - self.sequence_length + 1
-            x = X[:, i_start:(i + 1), :]
+    def windows(self, start=0, stop=None):
+        """
+        Windows of hours [start, stop) as one strided view of shape
+        (hours, sequence_length, provinces, 1, features), i.e. a batch of items.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        x = self.X_padded[:, start:stop + self.sequence_length - 1]
+        return x.unfold(1, self.sequence_length, 1).permute(1, 3, 0, 2).unsqueeze(3)
+    
+    def batch(self, index):
+        """
+        Batch of the windows and targets of a slice or an array of hours. Contiguous
+        hours are served from the strided view, others are gathered in one indexing.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            x = self.windows(start, stop)[::step]
         else:
-            padding_needed = self.sequence_length - i - 1
-            x = self._mirror_padding(X, self.sequence_length, padding_needed)
-            x = x[:, :self.sequence_length, :]
-        return x
+            index = torch.as_tensor(index, dtype=torch.long)
+            x = self.X_padded.unfold(1, self.sequence_length, 1)[:, index].permute(1, 3, 0, 2).unsqueeze(3)
+            start, stop, step = None, None, None
+        x = x.float()
+        if self.predict:
+            return x
+        y = self.y[:, start:stop:step] if start is not None else self.y[:, index]
+        return x, y.permute(1, 0, 2).flatten(1).float()
 
     def __getitem__(self, i):
-        x_window = self._get_window(self.X, i)
-        x_window = x_window.permute(1, 0, 2).unsqueeze(2)
+        if not isinstance(i, (int, np.integer)):
+            return self.batch(i)
+        # the padded tensor holds sequence_length - 1 mirrored hours before hour 0
+        x_window = self.X_padded[:, i:i + self.sequence_length].permute(1, 0, 2).unsqueeze(2).float()
         if self.predict: 
             return x_window
-        return x_window, self.y[:, i, :].flatten()
\ No newline at end of file
+        return x_window, self.y[:, i, :].flatten().float()
+
+
+class WindowBatchSampler(Sampler):
+    """
+    Batches of hours for a TimeSeries3DDataset: contiguous slices in order, or shuffled
+    index arrays. Use with DataLoader(dataset, sampler=..., batch_size=None) so that each
+    batch is served by one call of the dataset.
+    """
+    def __init__(self, n, batch_size, shuffle=False, drop_last=False, seed=None):
+        self.n = n
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+            
+    def __len__(self):
+        return self.n // self.batch_size if self.drop_last else -(-self.n // self.batch_size)
+    
+    def __iter__(self):
+        order = torch.randperm(self.n, generator=self.generator) if self.shuffle else None
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            stop = min(start + self.batch_size, self.n)
+            yield order[start:stop] if self.shuffle else slice(start, stop)
+
+
+def batch_loader(dataset, batch_size, shuffle=False, drop_last=False, seed=None, **kwargs):
+    """DataLoader over whole batches of a TimeSeries3DDataset, see WindowBatchSampler."""
+    sampler = WindowBatchSampler(len(dataset), batch_size, shuffle, drop_last, seed)
+    return DataLoader(dataset, sampler=sampler, batch_size=None, **kwargs)
\ No newline at end of file
@@ -0,0 +1,96 @@
+import io
+import numpy as np
+import pandas as pd
+import torch
+from time import perf_counter
+from utils import sliding_window, read_cube
+from model_wrapper import GRUPredictor, ConvLSTMPredictor
+import storage
+
+# Accuracy report of the int8 dynamically quantized forecasters against their
+# float32 versions, on the held-out split of the history in data/.
+
+POLLUTANTS = ["co", "no2", "o3", "so2", "pm2_5", "pm10"]
+
+
+def model_size(model):
+    """Size in bytes of the serialized state dict."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def errors(y_true, y_pred):
+    """RMSE and MAE per pollutant, over the samples where truth and prediction are valid."""
+    y_true, y_pred = y_true.reshape(-1, len(POLLUTANTS)), y_pred.reshape(-1, len(POLLUTANTS))
+    valid = np.isfinite(y_true) & np.isfinite(y_pred) & (y_true >= 0)
+    error = np.where(valid, y_pred - y_true, 0)
+    n = valid.sum(axis=0)
+    return np.sqrt((error ** 2).sum(axis=0) / n), np.abs(error).sum(axis=0) / n
+
+
+def compare(name, y_true, float_predict, int8_predict, float_model, int8_model):
+    """Run both models, print their size and speed and return the per-pollutant error report."""
+    start = perf_counter()
+    y_float = float_predict()
+    float_time = perf_counter() - start
+    start = perf_counter()
+    y_int8 = int8_predict()
+    int8_time = perf_counter() - start
+
+    float_rmse, float_mae = errors(y_true, y_float)
+    int8_rmse, int8_mae = errors(y_true, y_int8)
+    report = pd.DataFrame({
+        "float_rmse": float_rmse,
+        "int8_rmse": int8_rmse,
+        "rmse_drift_%": 100 * (int8_rmse - float_rmse) / float_rmse,
+        "float_mae": float_mae,
+        "int8_mae": int8_mae,
+        "mae_drift_%": 100 * (int8_mae - float_mae) / float_mae,
+        "max_abs_diff": np.nanmax(np.abs(y_int8 - y_float).reshape(-1, len(POLLUTANTS)), axis=0),
+    }, index=pd.Index(POLLUTANTS, name="pollutant")).round(3)
+    print(f"{name}: float32 {model_size(float_model) / 2**20:.1f}MB {float_time:.2f}s, "
+          f"int8 {model_size(int8_model) / 2**20:.1f}MB {int8_time:.2f}s")
+    return report
+
+
+def gru_split(predictor, start="2024-01-01", extra_dir="data/region/vietnam/extra_info.csv"):
+    """Windows, init rows and targets of every province from `start` on."""
+    predictor.input_dir = "data/weather"
+    init_df = pd.read_csv(extra_dir).set_index("id")
+    Xs, init_data, ys = [], [], []
+    for i in init_df.index:
+        weather_df = predictor.get_dataframe(i)
+        weather_df = weather_df[weather_df["time"] >= start].dropna()
+        air_df = storage.read_table("data/air_quality", i).drop(columns="aqi")
+        air_df = air_df[(air_df["time"] >= start) & (air_df[POLLUTANTS] >= 0).all(axis=1)]
+        X, y = sliding_window(weather_df, air_df, target_size="one")
+        Xs.append(X)
+        ys.append(y)
+        init_data.append(np.repeat(init_df.loc[[i]].to_numpy()[:, :3], len(X), axis=0))
+    return np.concatenate(Xs), np.concatenate(init_data), np.concatenate(ys)
+
+
+def report_gru(start="2024-01-01"):
+    float_predictor, int8_predictor = GRUPredictor(), GRUPredictor(quantize=True)
+    X, init_data, y = gru_split(float_predictor, start)
+    return compare("GRU", y, lambda: float_predictor.predict(X, init_data), lambda: int8_predictor.predict(X, init_data),
+                   float_predictor.model, int8_predictor.model)
+
+
+def report_conv_lstm(start="2024-01-01"):
+    float_predictor, int8_predictor = ConvLSTMPredictor(batch_size=256), ConvLSTMPredictor(batch_size=256, quantize=True)
+    weather_cube, air_cube = read_cube("vietnam", "weather"), read_cube("vietnam", "air_quality")
+    first = max(pd.Timestamp(start), weather_cube.time_index[0], air_cube.time_index[0])
+    last = min(weather_cube.time_index[-1], air_cube.time_index[-1]) + pd.Timedelta(hours=1)
+    weather = float_predictor.get_features(weather_cube.slice_time(first, last))
+    # quantized linear layers reject NaN inputs, fill the scraping gaps so both models see the same windows
+    weather = np.stack([pd.DataFrame(province).ffill().bfill().to_numpy() for province in weather])
+    y = air_cube.slice_time(first, last).take(float_predictor.ids, POLLUTANTS).transpose(1, 0, 2)
+    return compare("ConvLSTM", y, lambda: float_predictor.predict_weather(weather), lambda: int8_predictor.predict_weather(weather),
+                   float_predictor.model, int8_predictor.model)
+
+
+if __name__ == "__main__":
+    print(report_gru())
+    print(report_conv_lstm())
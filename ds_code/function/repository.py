@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from threading import Lock
+from utils import read_cube
+from aqi import read_aqi
+
+# Forecast cubes of a region, loaded the first time a (source, model) pair is
+# selected and kept memory-mapped in a bounded LRU cache. "aqi_index" holds the
+# sub-indices and AQI computed from the "aqi" pollutant forecasts.
+MODELS = {"weather": [None], "aqi": ["random_forest", "gru", "conv_lstm"], "aqi_index": ["random_forest", "gru", "conv_lstm"]}
+
+
+def invalidated(key, source=None, model=None):
+    """Whether a key starting with (source, model) is dropped by invalidate(source, model)."""
+    sources = None if source is None else {source, "aqi_index"} if source == "aqi" else {source}
+    return sources is None or key[0] in sources and (model is None or key[1] == model)
+
+
+class ForecastRepository:
+    def __init__(self, region_folder="vietnam", src="forecast", max_size=2):
+        self.region_folder = region_folder
+        self.src = src
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        self.listeners = []
+        
+    def src_folder(self, source, model=None):
+        if model not in MODELS[source]:
+            raise KeyError((source, model))
+        if source == "aqi_index":
+            source = "aqi"
+        return source if model is None else source + "/" + model
+        
+    def get(self, source, model=None):
+        """Cube of a source ("weather", "aqi" or "aqi_index") and model, loading it on the first request."""
+        key = (source, model)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            read = read_aqi if source == "aqi_index" else read_cube
+            cube = read(self.region_folder, self.src_folder(source, model), src=self.src)
+            self.cache[key] = cube
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+            return cube
+        
+    def values(self, source, model, time, provinces, attr):
+        """Values of one attribute of the provinces at a time, KeyError if the time is not covered."""
+        cube = self.get(source, model)
+        return cube.values[cube.locate_time(time), cube.province_index(provinces), cube.features.index(attr)]
+    
+    def invalidate(self, source=None, model=None):
+        """
+        Drop cached cubes of a source (every source by default), of one of its models or
+        all of them, so they are read again. The AQI indices follow their pollutant forecasts.
+        Listeners (e.g. the rendered payloads of the map) are called with the same arguments.
+        """
+        with self.lock:
+            for key in [key for key in self.cache if invalidated(key, source, model)]:
+                del self.cache[key]
+        for listener in self.listeners:
+            listener(source, model)
+
+
+_shared = {}
+
+
+def shared_repository(region_folder="vietnam", src="forecast"):
+    """Repository shared by every caller of the same region."""
+    key = (region_folder, src)
+    if key not in _shared:
+        _shared[key] = ForecastRepository(region_folder, src)
+    return _shared[key]
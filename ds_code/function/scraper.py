@@ -1,51 +1,231 @@
 import os
 import requests
 import json
+from io import StringIO
 import pandas as pd
-from time import time, sleep
-from datetime import datetime
+from time import time, sleep, monotonic
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+import storage
+import coverage_index
+import metrics
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` requests per second with bursts up to `capacity`."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.last = monotonic()
+        self.lock = Lock()
+        
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+            
+    def pause(self, seconds):
+        """Drain the bucket so that every caller waits at least `seconds` (used on HTTP 429)."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def retry_after(response):
+    """Read the Retry-After header (seconds or HTTP date) of a response, None if absent."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+        except (TypeError, ValueError):
+            return None
+
 
 class Scraper:
-    def __init__(self):
+    def __init__(self, rate=None, workers=8, max_retries=5, backoff=1.0, timeout=60, max_delay=300):
         self.raw_url = None
         self.folder = None
         self.json = None
         self.df = None
         
-    def get_json(self, *args):
+        # shared pooled session, one connection per worker thread
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        
+        # rate limiting and retry policy
+        self.limiter = TokenBucket(rate) if rate else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_delay = max_delay
+        
+    def request_json(self, *args):
+        """
+        Request the url formatted with `args` and return the decoded json, or
+        None on failure. HTTP 429 and 5xx responses and bodies that are not json are
+        retried up to `max_retries` times with exponential backoff, honoring Retry-After,
+        waiting at most `max_delay` seconds between attempts.
+        """
         url = self.raw_url.format(*args)
-        response = requests.get(url)
-        print(url)
-        
-        if response.status_code == 429:
-            print("API request limit exceeded, retry in 30 seconds")
-            sleep(30)
-            self.get_json(*args)
-        elif response.status_code == 200:
-            print("Request OK")
-            self.json = response.json()
-            return True
-        else:
-            print(f'Error: Request failed with status code {response.status_code}')
-            return False
+        scraper = type(self).__name__
+        for attempt in range(self.max_retries + 1):
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                with metrics.timer("http_request_seconds", scraper=scraper):
+                    response = self.session.get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                print(f"Error: Request to {url} failed ({e})")
+                metrics.count("http_errors", scraper=scraper)
+                response = None
+            else:
+                metrics.count("http_responses", scraper=scraper, status=response.status_code)
+                metrics.count("http_bytes", len(response.content), scraper=scraper)
+                if response.status_code == 200:
+                    try:
+                        return response.json()
+                    except ValueError:
+                        print(f"Error: Malformed json from {url}")
+                        metrics.count("http_errors", scraper=scraper)
+                elif response.status_code != 429 and response.status_code < 500:
+                    print(f'Error: Request failed with status code {response.status_code}')
+                    return None
+                
+            if attempt == self.max_retries:
+                break
+            delay = retry_after(response) if response is not None else None
+            delay = min(self.backoff * 2 ** attempt if delay is None else delay, self.max_delay)
+            if response is not None and response.status_code == 429:
+                print(f"API request limit exceeded, retry in {delay:g} seconds")
+                metrics.count("http_rate_limited", scraper=scraper)
+                if self.limiter:
+                    self.limiter.pause(delay)
+            sleep(delay)
+            
+        print(f"Error: Giving up on {url} after {self.max_retries + 1} attempts")
+        return None
         
-    def to_dataframe(self):
+    def get_json(self, *args):
+        self.json = self.request_json(*args)
+        return self.json is not None
+        
+    def parse(self, json):
+        """Convert a json response to a dataframe."""
         pass
         
-    def store(self, filename):
+    def to_dataframe(self):
+        self.df = self.parse(self.json)
+        
+    def store(self, filename, df=None):
         #self.df.dropna(thresh=3, inplace=True)
-        path = self.folder + "\\" + filename
-        self.df.to_csv(path, index=False)
+        df = self.df if df is None else df
+        path = os.path.join(self.folder, filename)
+        df.to_csv(path, index=False)
         
     def scrape_and_store(self, filename, *args):
         if self.get_json(*args):
             self.to_dataframe()
             self.store(filename)
+            return True
+        return False
+    
+    def _scrape_job(self, name, args):
+        """Thread-safe scrape of one table, leaving the instance state untouched."""
+        start = monotonic()
+        try:
+            json = self.request_json(*args)
+            if json is not None:
+                self.store(name, self.parse(json))
+            error = None if json is not None else "request failed"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        return {"ok": error is None, "seconds": round(monotonic() - start, 3), "error": error}
+        
+    def scrape_many(self, jobs, job=None):
+        """
+        Scrape and store many tables concurrently on `workers` threads.
+        `jobs` maps each table name to the url arguments. Return a per-table report.
+        """
+        job = job or self._scrape_job
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {name: pool.submit(job, name, args) for name, args in jobs.items()}
+            report = pd.DataFrame.from_dict({name: future.result() for name, future in futures.items()}, orient="index")
+        report.index.name = "name"
+        if len(report):
+            print(f"Scraped {report['ok'].sum()}/{len(report)} tables, failed: {list(report.index[~report['ok']])}")
+        return report
             
             
+def chunk_range(start, end, step, resolution):
+    """Split the closed range [start, end] into consecutive closed spans of at most `step`."""
+    spans = []
+    while start <= end:
+        last = min(start + step - resolution, end)
+        spans.append((start, last))
+        start = last + resolution
+    return spans
+
+
 class TimeSeriesScraper(Scraper):
+    chunk = timedelta(days=365)
+    
     def mass_scrape(self, df, start, end):
         pass
+    
+    def store(self, name, df=None):
+        """Store a table through the storage layer, in its configured format, and index its coverage."""
+        storage.write_table(self.df if df is None else df, self.folder, name)
+        coverage_index.update(self.folder, name)
+    
+    def last_time(self, name):
+        """Timestamp of the last row holding a value stored for `name`, None if there is no such row."""
+        return storage.last_time(self.folder, name)
+    
+    def _append_job(self, name, spans):
+        """Scrape the spans missing from one table and append them, see `_scrape_job`."""
+        start = monotonic()
+        rows, error = 0, None
+        try:
+            dfs = []
+            for args in spans:
+                json = self.request_json(*args)
+                if json is None:
+                    error = "request failed"
+                    break
+                dfs.append(self.parse(json))
+            # only keep the spans before the first failure so that the table stays gap-free
+            if dfs:
+                new_df = pd.concat(dfs, ignore_index=True)
+                values = new_df.drop(columns="time")
+                # trailing hours the API has not published yet come back empty
+                filled = values.notna().any(axis=1).to_numpy()
+                new_df = new_df.iloc[:filled.nonzero()[0][-1] + 1] if filled.any() else new_df.iloc[:0]
+                rows = storage.append_table(new_df, self.folder, name)
+                coverage_index.update(self.folder, name)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        return {"ok": error is None, "seconds": round(monotonic() - start, 3), "error": error, "rows": rows}
             
             
 class CountryScraper(Scraper):
@@ -55,61 +235,91 @@ class CountryScraper(Scraper):
         self.folder = "data/countries"
         
     def to_dataframe(self):
-        path = "data" + "\\" + self.folder + "\\" + 'countries.json'
+        path = os.path.join(self.folder, 'countries.json')
         with open(path, 'w') as json_file:
             json.dump(self.json["geonames"], json_file, indent=4)  
         self.df = pd.read_json(path)
     
 
 class WeatherScraper(TimeSeriesScraper):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, rate=8, **kwargs):                   # Open-Meteo allows 600 calls per minute
+        super().__init__(rate, **kwargs)
         self.folder = "data/weather"
         self.raw_url = "https://archive-api.open-meteo.com/v1/archive?latitude={}&longitude={}&start_date={}&end_date={}&hourly=temperature_2m,relative_humidity_2m,dew_point_2m,precipitation,surface_pressure,cloud_cover,wind_speed_10m,wind_direction_10m&timezone=auto"
         
-    def to_dataframe(self):
-        self.df = pd.DataFrame(self.json['hourly'])
+    def parse(self, json):
+        return pd.DataFrame(json['hourly'])
         
-    def mass_scrape(self, df, start="2020-11-28", end="now", overwrite=True):
+    def mass_scrape(self, df, start="2020-11-28", end="now", overwrite=True, append=False):
+        """
+        Scrape the hourly weather of every city in `df` between `start` and `end`.
+        With append=True, only the days from the last stored hour onwards are
+        requested (in `chunk` sized spans) and appended to the existing files.
+        """
         if end == "now":
             end = datetime.fromtimestamp(time()).strftime("%Y-%m-%d")
             
+        jobs = {}
         for i in range(df.shape[0]):
             row = df.loc[i]
-            if overwrite or not os.path.exists("data" + "\\" + self.folder + "\\" + str(row["id"]) + ".csv"):
-                self.scrape_and_store(str(row["id"]) + ".csv", row["lat"], row["lng"], start, end)
+            name = str(row["id"])
+            if append:
+                last = self.last_time(name)
+                first = datetime.strptime(start, "%Y-%m-%d") if last is None else last.replace(hour=0, minute=0)
+                spans = chunk_range(first, datetime.strptime(end, "%Y-%m-%d"), self.chunk, timedelta(days=1))
+                jobs[name] = [(row["lat"], row["lng"], a.strftime("%Y-%m-%d"), b.strftime("%Y-%m-%d")) for a, b in spans]
+            elif overwrite or not storage.exists(self.folder, name):
+                jobs[name] = (row["lat"], row["lng"], start, end)
+        return self.scrape_many(jobs, self._append_job if append else None)
                 
     def forecast_scrape(self, df):
         self.folder = "forecast/weather"
         self.raw_url = "https://api.open-meteo.com/v1/forecast?latitude={}&longitude={}&hourly=temperature_2m,relative_humidity_2m,dew_point_2m,precipitation,surface_pressure,cloud_cover,wind_speed_10m,wind_direction_10m&timezone=auto&past_days=1"
         
+        jobs = {}
         for i in range(df.shape[0]):
             row = df.loc[i]
-            self.scrape_and_store(str(row["id"]) + ".csv", row["lat"], row["lng"])    
+            jobs[str(row["id"])] = (row["lat"], row["lng"])
+        return self.scrape_many(jobs)
 
 class AQIScraper(TimeSeriesScraper):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, rate=1, **kwargs):                   # OpenWeatherMap free plan allows 60 calls per minute
+        super().__init__(rate, **kwargs)
         self.folder = "data/air_quality"
         self.raw_url = "http://api.openweathermap.org/data/2.5/air_pollution/history?lat={}&lon={}&start={}&end={}&appid=b34c8120213e3f26c596cfb41b21cb86"
         
-    def to_dataframe(self):
-        json = str({datetime.fromtimestamp(obj["dt"]).strftime("%Y-%m-%dT%H:%M:%S"): obj["components"] | obj["main"] for obj in self.json["list"]}).replace('\'', '"')
-        self.df = pd.read_json(json, orient="index").drop(["no", "nh3"], axis=1)
-        self.df.index.name = "time"
-        self.df.reset_index(inplace=True)
+    def parse(self, json):
+        if not json["list"]:
+            return pd.DataFrame(columns=["time", "co", "no2", "o3", "so2", "pm2_5", "pm10", "aqi"])
+        json = str({datetime.fromtimestamp(obj["dt"]).strftime("%Y-%m-%dT%H:%M:%S"): obj["components"] | obj["main"] for obj in json["list"]}).replace('\'', '"')
+        df = pd.read_json(StringIO(json), orient="index").drop(["no", "nh3"], axis=1)
+        df.index.name = "time"
+        return df.reset_index()
         
-    def mass_scrape(self, df, start="2020-11-28", end="now", overwrite=True):
+    def mass_scrape(self, df, start="2020-11-28", end="now", overwrite=True, append=False):
+        """
+        Scrape the hourly air quality of every city in `df` between `start` and `end`.
+        With append=True, only the hours after the last stored one are
+        requested (in `chunk` sized spans) and appended to the existing files.
+        """
         start_stamp = int(datetime.strptime(start, "%Y-%m-%d").timestamp())
         if end == "now":
             end_stamp = int(time())
         else:
             end_stamp = int(datetime.strptime(end, "%Y-%m-%d").timestamp())
 
+        jobs = {}
         for i in range(df.shape[0]):
             row = df.loc[i]
-            if overwrite or not os.path.exists("data" + "\\" + self.folder + "\\" + str(row["id"]) + ".csv"):
-                self.scrape_and_store(str(row["id"]) + ".csv", row["lat"], row["lng"], start_stamp, end_stamp)
+            name = str(row["id"])
+            if append:
+                last = self.last_time(name)
+                first = start_stamp if last is None else int(last.timestamp()) + 3600
+                spans = chunk_range(first, end_stamp, int(self.chunk.total_seconds()), 3600)
+                jobs[name] = [(row["lat"], row["lng"], a, b) for a, b in spans]
+            elif overwrite or not storage.exists(self.folder, name):
+                jobs[name] = (row["lat"], row["lng"], start_stamp, end_stamp)
+        return self.scrape_many(jobs, self._append_job if append else None)
         
     
 if __name__ == "__main__":
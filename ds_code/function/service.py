@@ -0,0 +1,255 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from queue import Queue, Empty
+from threading import Thread, Lock
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import monotonic, perf_counter
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from model_wrapper import RandomForestPredictor, GRUPredictor, ConvLSTMPredictor, window_inputs, cube_features
+from utils import group_cube, to_epoch
+import metrics
+
+# Long-lived forecast service keeping the three models and their scalers loaded.
+# Forecasts of a province are computed from the forecast weather tables on the first
+# query, concurrent queries of a model are grouped into one forward pass, and
+# results are cached under the snapshot (file times and sizes) of the input tables.
+#
+#   python ds_code/function/service.py --port 8765
+#   GET /forecast?model=gru&province=1704413791&start=2024-11-20T00:00&end=2024-11-21T00:00
+#   GET /forecast?model=conv_lstm&lat=21.0&lng=105.85
+#   GET /health, GET /metrics (Prometheus text), POST /reload
+PREDICTORS = {"random_forest": RandomForestPredictor, "gru": GRUPredictor, "conv_lstm": ConvLSTMPredictor}
+COLUMNS = ["co", "no2", "o3", "so2", "pm2_5", "pm10"]
+ROUTES = ["/forecast", "/health", "/metrics"]
+
+
+class MicroBatcher:
+    """
+    Collect the keys submitted concurrently during `max_wait` seconds (at most `max_batch`
+    of them) and compute them with one call of `compute(keys)`, returning {key: result}.
+    """
+    def __init__(self, compute, max_batch=64, max_wait=0.005):
+        self.compute = compute
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        Thread(target=self._run, daemon=True).start()
+
+    def submit(self, key):
+        future = Future()
+        self.queue.put((key, future))
+        return future
+
+    def _run(self):
+        while True:
+            key, future = self.queue.get()
+            batch = {key: [future]}
+            deadline = monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    key, future = self.queue.get(timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+                batch.setdefault(key, []).append(future)
+
+            metrics.observe("serve_batch_size", len(batch))
+            try:
+                results = self.compute(list(batch))
+            except Exception as e:
+                for futures in batch.values():
+                    for future in futures:
+                        future.set_exception(e)
+                continue
+            for key, futures in batch.items():
+                for future in futures:
+                    if key in results:
+                        future.set_result(results[key])
+                    else:
+                        future.set_exception(KeyError(key))
+
+
+class ForecastService:
+    def __init__(self, models=None, threads=None, cache_size=1024, max_wait=0.005,
+                 input_dir="forecast/weather", extra_dir="data/region/vietnam/extra_info.csv"):
+        self.input_dir = input_dir
+        self.init_df = pd.read_csv(extra_dir).set_index("id")
+        cities = pd.read_csv("data/region/vietnam/cities.csv").set_index("id").loc[self.init_df.index]
+        self.names = cities["admin_name"].to_dict()
+        self.coordinates = np.radians(cities[["lat", "lng"]].to_numpy())
+        self.predictors = {}
+        for name in models or PREDICTORS:
+            if name == "random_forest":
+                self.predictors[name] = RandomForestPredictor(n_jobs=threads or -1)
+            else:
+                self.predictors[name] = PREDICTORS[name](num_threads=threads)
+            self.predictors[name].input_dir = input_dir
+        self.batchers = {name: MicroBatcher(lambda keys, name=name: self.compute(name, keys), max_wait=max_wait)
+                         for name in self.predictors}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = Lock()
+
+    def snapshot(self):
+        """Key of the current forecast weather, changing whenever a table is written."""
+        entries = [entry.stat() for entry in os.scandir(self.input_dir) if entry.is_file()]
+        return (len(entries), max((s.st_mtime_ns for s in entries), default=0), sum(s.st_size for s in entries))
+
+    def nearest(self, lat, lng):
+        """Id of the province whose city is closest to (lat, lng)."""
+        lat, lng = np.radians(lat), np.radians(lng)
+        a = (np.sin((self.coordinates[:, 0] - lat) / 2) ** 2
+             + np.cos(lat) * np.cos(self.coordinates[:, 0]) * np.sin((self.coordinates[:, 1] - lng) / 2) ** 2)
+        return int(self.init_df.index[np.argmin(a)])
+
+    def compute(self, model, keys):
+        """Forecast every (snapshot, province) key of a model with one forward pass and cache the results."""
+        predictor = self.predictors[model]
+        ids = sorted({province for _, province in keys})
+        start = perf_counter()
+        if model == "conv_lstm":
+            # the ConvLSTM forecasts every province at once, streaming the hours appended since the last call
+            cube = group_cube("vietnam", "weather", src="forecast", save=False)
+            ids, weather = cube_features(cube)
+            output = predictor.predict_stream(weather, cube.time, ids)
+            results = {int(i): (cube.time, np.round(output[p], 2)) for p, i in enumerate(ids)}
+        else:
+            time_idxs, X, init_data = window_inputs([predictor.get_dataframe(i) for i in ids], self.init_df.loc[ids])
+            output = np.round(predictor.predict(X, init_data), 2)
+            splits = np.cumsum([len(time_idx) for time_idx in time_idxs])[:-1]
+            results = {int(i): (to_epoch(time_idx), values)
+                       for i, time_idx, values in zip(ids, time_idxs, np.split(output, splits))}
+        metrics.observe("serve_compute_seconds", perf_counter() - start, model=model)
+
+        snapshots = {snapshot for snapshot, _ in keys}
+        results = {(snapshot, i): result for snapshot in snapshots for i, result in results.items()}
+        with self.lock:
+            for key, result in results.items():
+                self.cache[(model,) + key] = result
+                self.cache.move_to_end((model,) + key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return results
+
+    def forecast(self, model, province, start=None, end=None):
+        """(epochs, values) of the forecast of a province between the `start` and `end` timestamps (inclusive)."""
+        if model not in self.predictors:
+            raise KeyError(f"unknown model {model}")
+        if province not in self.names:
+            raise KeyError(f"unknown province {province}")
+        key = (self.snapshot(), province)
+        with self.lock:
+            result = self.cache.get((model,) + key)
+            if result is not None:
+                self.cache.move_to_end((model,) + key)
+        metrics.count("serve_cache_hits" if result is not None else "serve_cache_misses", model=model)
+        if result is None:
+            result = self.batchers[model].submit(key).result()
+
+        time, values = result
+        a = 0 if start is None else np.searchsorted(time, int(pd.Timestamp(start).timestamp()))
+        b = len(time) if end is None else np.searchsorted(time, int(pd.Timestamp(end).timestamp()), side="right")
+        return time[a:b], values[a:b]
+
+    def query(self, params):
+        """Answer a /forecast query string, as a JSON serializable dict."""
+        model = params.get("model", "random_forest")
+        if "province" in params:
+            province = int(params["province"])
+        elif "lat" in params and "lng" in params:
+            province = self.nearest(float(params["lat"]), float(params["lng"]))
+        else:
+            raise ValueError("a province id or lat and lng are required")
+        time, values = self.forecast(model, province, params.get("start"), params.get("end"))
+        return {"model": model, "province": province, "name": self.names[province], "columns": COLUMNS,
+                "time": pd.to_datetime(time, unit="s").strftime("%Y-%m-%dT%H:%M").tolist(),
+                "values": values.tolist()}
+
+    def preload(self):
+        """Forecast every province with every model, so that the first queries are answered from the cache."""
+        snapshot = self.snapshot()
+        for model, batcher in self.batchers.items():
+            futures = [batcher.submit((snapshot, int(i))) for i in self.init_df.index]
+            for future in futures:
+                future.result()
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        # labelled with the route rather than the raw path, which any client can vary
+        route = url.path if url.path in ROUTES else "other"
+        with metrics.timer("serve_request_seconds", path=route):
+            if url.path == "/health":
+                return self.send_json(200, {"models": list(self.service.predictors), "cached": len(self.service.cache)})
+            if url.path == "/metrics":
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                return self.wfile.write(body)
+            if url.path != "/forecast":
+                return self.send_json(404, {"error": f"unknown path {url.path}"})
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                self.send_json(200, self.service.query(params))
+            except KeyError as e:
+                self.send_json(404, {"error": str(e.args[0]) if e.args else "not found"})
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+            except Exception as e:
+                metrics.count("serve_errors")
+                self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/reload":
+            return self.send_json(404, {"error": f"unknown path {self.path}"})
+        self.service.clear()
+        self.send_json(200, {"cached": 0})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(service, host="127.0.0.1", port=8765):
+    Handler.service = service
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    print(f"Serving forecasts on http://{host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the air quality forecasts of the loaded models over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--models", nargs="+", choices=list(PREDICTORS), default=list(PREDICTORS))
+    parser.add_argument("--threads", type=int, default=None, help="threads of the models")
+    parser.add_argument("--max-wait", type=float, default=0.005, help="seconds a query waits for others to batch with")
+    parser.add_argument("--preload", action="store_true", help="forecast every province before serving")
+    args = parser.parse_args()
+
+    metrics.enable()
+    service = ForecastService(args.models, args.threads, max_wait=args.max_wait)
+    if args.preload:
+        service.preload()
+    serve(service, args.host, args.port)
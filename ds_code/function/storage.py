@@ -0,0 +1,390 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from glob import glob
+from numpy.lib.recfunctions import structured_to_unstructured
+try:
+    import metrics
+except ImportError:                         # imported as ds_code.function.storage from the notebooks
+    from . import metrics
+
+# Tables are hourly time series with a "time" column and numeric value columns.
+# In "npy" format a table is one structured array (int64 epoch seconds followed
+# by float32 values) that is memory-mapped on read instead of parsed.
+FORMAT = "npy"
+FORMATS = ("npy", "csv")
+
+
+def table_path(folder, name, fmt=None):
+    return os.path.join(folder, f"{name}.{fmt or FORMAT}")
+
+
+def find_table(folder, name):
+    """Path of the stored table, preferring the binary format over CSV."""
+    for fmt in FORMATS:
+        path = table_path(folder, name, fmt)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def exists(folder, name):
+    return find_table(folder, name) is not None
+
+
+def table_dtype(columns):
+    return np.dtype([("time", "<i8")] + [(col, "<f4") for col in columns])
+
+
+def to_records(df):
+    """Convert a dataframe with a "time" column to the structured array stored on disk."""
+    columns = [col for col in df.columns if col != "time"]
+    records = np.empty(len(df), dtype=table_dtype(columns))
+    records["time"] = pd.to_datetime(df["time"]).to_numpy().astype("datetime64[s]").astype(np.int64)
+    for col in columns:
+        records[col] = df[col].to_numpy(dtype=np.float32, na_value=np.nan)
+    return records
+
+
+def from_records(records):
+    df = pd.DataFrame({col: records[col] for col in records.dtype.names[1:]})
+    df.insert(0, "time", records["time"].astype("datetime64[s]"))
+    return df
+
+
+def _save(path, records):
+    with open(path, "wb") as f:
+        np.save(f, records)
+
+
+def _dump_json(path, obj):
+    with open(path, "w") as f:
+        json.dump(obj, f)
+
+
+def _write_at(f, position, data):
+    f.seek(position)
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _replace(path, write):
+    """Write through a temporary file then swap it in, so readers never see partial files."""
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_table(df, folder, name, fmt=None):
+    """Store a dataframe with a "time" column as `folder/name.<fmt>`."""
+    path = table_path(folder, name, fmt)
+    with metrics.timer("io_write_seconds", fmt=fmt or FORMAT):
+        if (fmt or FORMAT) == "npy":
+            records = to_records(df)
+            _replace(path, lambda tmp_path: _save(tmp_path, records))
+        else:
+            _replace(path, lambda tmp_path: df.to_csv(tmp_path, index=False))
+    return path
+
+
+def read_records(folder, name, mmap=True):
+    """
+    Structured array of a stored table, memory-mapped for the binary format.
+    CSV tables are parsed and converted to the same layout.
+    """
+    path = find_table(folder, name)
+    if path is None:
+        raise FileNotFoundError(table_path(folder, name))
+    if path.endswith(".npy"):
+        with metrics.timer("io_read_seconds", fmt="npy"):
+            return np.load(path, mmap_mode="r" if mmap else None)
+    with metrics.timer("io_read_seconds", fmt="csv"):
+        return to_records(pd.read_csv(path))
+
+
+def read_arrays(folder, name, columns=None):
+    """Return (epoch seconds, float32 values, column names) of a stored table."""
+    records = read_records(folder, name)
+    columns = list(columns or records.dtype.names[1:])
+    values = structured_to_unstructured(records[columns], copy=False)
+    return np.asarray(records["time"]), values, columns
+
+
+def read_table(folder, name, mmap=True):
+    """Read a stored table as a dataframe with a datetime "time" column and float32 values."""
+    return from_records(read_records(folder, name, mmap))
+
+
+def _filled_rows(records, chunk=168):
+    """Number of rows up to the last one holding a value, scanning back from the end by chunks."""
+    columns = list(records.dtype.names[1:])
+    end = len(records)
+    while end > 0:
+        a = max(end - chunk, 0)
+        filled = ~np.isnan(structured_to_unstructured(records[columns][a:end])).all(axis=1)
+        if filled.any():
+            return a + int(np.flatnonzero(filled)[-1]) + 1
+        end = a
+    return 0
+
+
+def _is_filled(line):
+    return any(value.strip() not in (b"", b"nan", b"NaN") for value in line.split(b",")[1:])
+
+
+def _csv_filled_end(path, chunk=4096):
+    """
+    (time, byte offset after the line) of the last row of a CSV table holding a value,
+    (None, offset after the header) if there is none. The file is read back from the end.
+    """
+    with open(path, "rb") as f:
+        header_end = len(f.readline())
+        end = f.seek(0, os.SEEK_END)
+        while end > header_end:
+            a = max(end - chunk, header_end)
+            f.seek(a)
+            block = f.read(end - a)
+            if a > header_end:
+                # the first line of the block may be cut, it is read whole with the next block
+                skip = block.find(b"\n") + 1
+                if skip == 0:
+                    chunk *= 2
+                    continue
+                a, block = a + skip, block[skip:]
+            lines = block.split(b"\n")
+            offset = end
+            for line in reversed(lines):
+                if _is_filled(line):
+                    return pd.to_datetime(line.split(b",")[0].decode()).to_pydatetime(), min(offset + 1, end)
+                offset -= len(line) + 1
+            end = a
+    return None, header_end
+
+
+def last_time(folder, name):
+    """
+    Timestamp of the last stored row holding a value, None if the table is missing or has none.
+    The empty rows after it (hours not published yet when scraped) are replaced on append.
+    """
+    path = find_table(folder, name)
+    if path is None:
+        return None
+    if path.endswith(".npy"):
+        records = np.load(path, mmap_mode="r")
+        n = _filled_rows(records)
+        return pd.Timestamp(records["time"][n - 1], unit="s").to_pydatetime() if n else None
+    return _csv_filled_end(path)[0]
+
+
+def append_table(df, folder, name):
+    """
+    Append the rows of `df` newer than the last stored row holding a value, deduplicated on time,
+    and return how many were written. The empty rows stored after it are dropped first and
+    the table is replaced atomically.
+    """
+    path = find_table(folder, name)
+    if path is None:
+        write_table(df, folder, name)
+        return len(df)
+
+    last = last_time(folder, name)
+    df = df.assign(_time=pd.to_datetime(df["time"]))
+    if last is not None:
+        df = df[df["_time"] > last]
+    df = df.drop_duplicates("_time", keep="last").sort_values("_time").drop(columns="_time")
+    if len(df) == 0:
+        return 0
+
+    if path.endswith(".npy"):
+        old = np.load(path)
+        old = old[:_filled_rows(old)]
+        new = to_records(df[list(old.dtype.names)])
+        _replace(path, lambda tmp_path: _save(tmp_path, np.concatenate((old, new))))
+        return len(df)
+
+    with open(path) as f:
+        columns = f.readline().strip().split(",")
+    _, end = _csv_filled_end(path)
+
+    def write(tmp_path):
+        with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+            remaining = end
+            while remaining:
+                data = src.read(min(remaining, 1 << 20))
+                dst.write(data)
+                remaining -= len(data)
+            src.seek(end - 1)
+            if src.read(1) != b"\n":
+                dst.write(b"\n")
+        df[columns].to_csv(tmp_path, mode="a", header=False, index=False)
+    _replace(path, write)
+    return len(df)
+
+
+def import_csv(folder, remove=False):
+    """Convert every CSV table of a folder to the binary format."""
+    for path in sorted(glob(os.path.join(folder, "*.csv"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        write_table(pd.read_csv(path), folder, name, fmt="npy")
+        if remove:
+            os.remove(path)
+
+
+def export_csv(folder, time_format="%Y-%m-%dT%H:%M"):
+    """Write a CSV copy of every binary table of a folder."""
+    for path in sorted(glob(os.path.join(folder, "*.npy"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        df = from_records(np.load(path, mmap_mode="r"))
+        df["time"] = df["time"].dt.strftime(time_format)
+        write_table(df, folder, name, fmt="csv")
+
+
+class Cube:
+    """
+    Dense float32 array of a region with shape (hours, provinces, features),
+    stored as values.npy, time.npy and meta.json in its own folder.
+    """
+    def __init__(self, time, provinces, features, values):
+        self.time = np.asarray(time, dtype=np.int64)
+        self.provinces = np.asarray(provinces, dtype=np.int64)
+        self.features = list(features)
+        self.values = values
+        
+    @classmethod
+    def stack(cls, provinces, tables, features=None):
+        """Align (epochs, values, columns) tables of each province on one hourly time axis."""
+        features = list(features or tables[0][2])
+        t0 = min(t[0] for t, _, _ in tables if len(t))
+        t1 = max(t[-1] for t, _, _ in tables if len(t))
+        time = np.arange(t0, t1 + 1, 3600, dtype=np.int64)
+        values = np.full((len(time), len(provinces), len(features)), np.nan, dtype=np.float32)
+        for p, (t, v, columns) in enumerate(tables):
+            on_grid = (t - t0) % 3600 == 0
+            values[(t[on_grid] - t0) // 3600, p] = v[on_grid][:, [columns.index(f) for f in features]]
+        return cls(time, provinces, features, values)
+    
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        _replace(os.path.join(folder, "values.npy"), lambda tmp_path: _save(tmp_path, np.ascontiguousarray(self.values, dtype=np.float32)))
+        _replace(os.path.join(folder, "time.npy"), lambda tmp_path: _save(tmp_path, self.time))
+        meta = {"provinces": self.provinces.tolist(), "features": self.features}
+        _replace(os.path.join(folder, "meta.json"), lambda tmp_path: _dump_json(tmp_path, meta))
+        
+    def save_at(self, folder, start):
+        """
+        Save the cube as the hours from row `start` on of the cube saved in `folder`, replacing
+        them and writing only these hours. The saved cube must have the same provinces and
+        features and reach the hour before this one. Unlike save() the values file is
+        modified in place: the rows are written before the header grows to cover them, and
+        time.npy is swapped last. load() keeps the hours present in both files, so readers,
+        and a crash in between, see the previous hours (some of the replaced ones possibly
+        rewritten already). Falls back to save() when the header has no room for the new shape.
+        """
+        if start == 0:
+            return self.save(folder)
+        old = Cube.load(folder)
+        if (not np.array_equal(old.provinces, self.provinces) or old.features != self.features
+                or start > len(old.time) or old.time[start - 1] + 3600 != self.time[0]):
+            raise ValueError(f"{folder}: the cube does not continue the saved cube at hour {start}")
+        time = np.concatenate((old.time[:start], self.time))
+        shape = tuple(int(n) for n in (start + len(self.time),) + self.values.shape[1:])
+
+        with open(os.path.join(folder, "values.npy"), "r+b") as f:
+            version = np.lib.format.read_magic(f)
+            header_start = f.tell() + (2 if version == (1, 0) else 4)
+            if version == (1, 0):
+                rows = np.lib.format.read_array_header_1_0(f)[0][0]
+            else:
+                rows = np.lib.format.read_array_header_2_0(f)[0][0]
+            offset = f.tell()
+            # the header is padded with spaces, a longer shape usually fits in the same length
+            header = str({"descr": "<f4", "fortran_order": False, "shape": shape})
+            header += " " * (offset - header_start - len(header) - 1) + "\n"
+            fits = len(header) == offset - header_start
+            if fits:
+                if shape[0] < rows:
+                    # shrinking, the header no longer covers the rows before they are cut
+                    _write_at(f, header_start, header.encode("latin1"))
+                f.seek(offset + start * 4 * int(np.prod(shape[1:])))
+                f.write(np.ascontiguousarray(self.values, dtype=np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+                _write_at(f, header_start, header.encode("latin1"))
+                f.truncate(offset + 4 * int(np.prod(shape)))
+        if not fits:
+            values = np.concatenate((np.asarray(old.values[:start], dtype=np.float32), self.values))
+            del old
+            return Cube(time, self.provinces, self.features, values).save(folder)
+        del old
+        _replace(os.path.join(folder, "time.npy"), lambda tmp_path: _save(tmp_path, time))
+        meta = {"provinces": self.provinces.tolist(), "features": self.features}
+        _replace(os.path.join(folder, "meta.json"), lambda tmp_path: _dump_json(tmp_path, meta))
+        
+    @classmethod
+    def load(cls, folder, mmap=True):
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        time = np.load(os.path.join(folder, "time.npy"))
+        values = np.load(os.path.join(folder, "values.npy"), mmap_mode="r" if mmap else None)
+        # the files differ in length while save_at runs, or after it was interrupted
+        n = min(len(time), len(values))
+        return cls(time[:n], meta["provinces"], meta["features"], values[:n])
+    
+    @property
+    def time_index(self):
+        return pd.DatetimeIndex(self.time.astype("datetime64[s]"), name="time")
+    
+    def locate_time(self, timestamp):
+        """Position of a timestamp on the time axis, KeyError if it is not covered."""
+        epoch = int(pd.Timestamp(timestamp).timestamp())
+        i = (epoch - self.time[0]) // 3600 if len(self.time) else -1
+        if i < 0 or i >= len(self.time) or self.time[i] != epoch:
+            raise KeyError(timestamp)
+        return i
+    
+    def slice_time(self, start=None, end=None):
+        """Cube restricted to the hours in [start, end), sharing the values array."""
+        a = 0 if start is None else np.searchsorted(self.time, int(pd.Timestamp(start).timestamp()))
+        b = len(self.time) if end is None else np.searchsorted(self.time, int(pd.Timestamp(end).timestamp()))
+        return Cube(self.time[a:b], self.provinces, self.features, self.values[a:b])
+    
+    def province_index(self, provinces):
+        """Positions of province ids on the province axis, KeyError for unknown ids."""
+        provinces = np.asarray(provinces, dtype=np.int64)
+        order = np.argsort(self.provinces, kind="stable")
+        pos = order[np.minimum(np.searchsorted(self.provinces, provinces, sorter=order), len(order) - 1)]
+        if not np.array_equal(self.provinces[pos], provinces):
+            raise KeyError(provinces[self.provinces[pos] != provinces].tolist())
+        return pos
+    
+    def feature_index(self, features):
+        return np.array([self.features.index(f) for f in features], dtype=np.int64)
+    
+    def take(self, provinces=None, features=None):
+        """Array of shape (hours, provinces, features) for a subset of the axes, in the given order."""
+        values = self.values
+        if provinces is not None:
+            values = values[:, self.province_index(provinces)]
+        if features is not None:
+            values = values[:, :, self.feature_index(features)]
+        return values
+
+
+def cube_is_stale(cube_folder, table_folder):
+    """Whether a table of the folder was written after the cube was saved."""
+    meta = os.path.join(cube_folder, "meta.json")
+    if not os.path.exists(meta):
+        return True
+    saved = os.path.getmtime(meta)
+    return any(entry.stat().st_mtime > saved for entry in os.scandir(table_folder)
+               if entry.name.endswith(tuple("." + fmt for fmt in FORMATS)))
+
+
+if __name__ == "__main__":
+    # convert the checked-in CSV trees to the binary format
+    for folder in ["data/weather", "data/air_quality", "forecast/weather",
+                   "forecast/aqi/random_forest", "forecast/aqi/gru", "forecast/aqi/conv_lstm"]:
+        import_csv(folder)
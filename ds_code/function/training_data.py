@@ -0,0 +1,131 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+from utils import sliding_window, intersect_runs
+from model_wrapper import add_wind_components
+import storage
+import coverage_index
+
+# Training windows are streamed city by city into memory-mapped .npy files of a folder:
+# X (rows, window, features), y (rows, window or 1, targets) and init (rows, 3) in
+# float32, index (rows,) of (city, time) with the time of the last hour of the window.
+INDEX_DTYPE = np.dtype([("city", "<i8"), ("time", "<i8")])
+
+
+def city_frames(city_id, wind_components=False, data_dir="data"):
+    """Weather and air quality tables of a city, preprocessed as in the training notebooks."""
+    air_df = storage.read_table(data_dir + "/air_quality", city_id)
+    air_df = air_df.loc[(air_df.iloc[:, 1:] >= 0).all(axis=1)].drop(columns="aqi")
+    weather_df = storage.read_table(data_dir + "/weather", city_id).dropna()
+    if wind_components:
+        weather_df = add_wind_components(weather_df)
+    return weather_df, air_df
+
+
+def count_city_windows(city_id, window_size=4, target_size="same", data_dir="data"):
+    """Number of windows `sliding_window` makes from `city_frames`, from the coverage index of the city."""
+    weather = coverage_index.load(data_dir + "/weather", city_id)
+    air = coverage_index.load(data_dir + "/air_quality", city_id)
+    if target_size == "one":
+        return coverage_index.count_windows(weather.present, window_size, "one", air.valid)
+    return coverage_index.count_windows(intersect_runs(weather.present, air.valid), window_size)
+
+
+def build_dataset(folder, extra_dir="data/region/vietnam/extra_info.csv", wind_components=False,
+                  window_size=4, target_size="same", data_dir="data"):
+    """
+    Write the training windows of every city of `extra_dir` to `folder`. The windows are
+    counted from the coverage index so the arrays are allocated on disk once, then
+    filled a city at a time, so memory holds at most the windows of one city.
+    """
+    city_data = pd.read_csv(extra_dir, index_col=0)
+    counts = [count_city_windows(city_id, window_size, target_size, data_dir) for city_id in city_data.index]
+    rows = sum(counts)
+
+    weather_df, air_df = city_frames(city_data.index[0], wind_components, data_dir)
+    n_targets = air_df.shape[1] - 1
+    os.makedirs(folder, exist_ok=True)
+    open_memmap = np.lib.format.open_memmap
+    X_all = open_memmap(os.path.join(folder, "X.npy"), "w+", np.float32, (rows, window_size, weather_df.shape[1] - 1))
+    y_all = open_memmap(os.path.join(folder, "y.npy"), "w+", np.float32, (rows, window_size if target_size == "same" else 1, n_targets))
+    init_all = open_memmap(os.path.join(folder, "init.npy"), "w+", np.float32, (rows, 3))
+    index_all = open_memmap(os.path.join(folder, "index.npy"), "w+", INDEX_DTYPE, (rows,))
+
+    start = 0
+    for city_id, count in zip(city_data.index, counts):
+        X, y, time = sliding_window(*city_frames(city_id, wind_components, data_dir), window_size, target_size, return_time=True)
+        stop = start + count
+        if len(X) != count:
+            raise ValueError(f"city {city_id}: {len(X)} windows instead of {count}, the tables changed during the build")
+        X_all[start:stop] = X
+        y_all[start:stop] = y.reshape(count, -1, n_targets)
+        init_all[start:stop] = city_data.loc[city_id].to_numpy()[:3]
+        index_all["city"][start:stop] = city_id
+        index_all["time"][start:stop] = time
+        start = stop
+    for array in (X_all, y_all, init_all, index_all):
+        array.flush()
+
+    meta = {"features": list(weather_df.columns[1:]), "targets": list(air_df.columns[1:]),
+            "window_size": window_size, "target_size": target_size}
+    with open(os.path.join(folder, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return folder
+
+
+class WindowDataset(Dataset):
+    """
+    Memory-mapped windows of a folder written by `build_dataset`, restricted to `rows`.
+    Items are ((X, init), y) tensors as expected by CustomGRU.
+    """
+    def __init__(self, folder, rows=None):
+        self.folder = folder
+        self.X = np.load(os.path.join(folder, "X.npy"), mmap_mode="r")
+        self.y = np.load(os.path.join(folder, "y.npy"), mmap_mode="r")
+        self.init = np.load(os.path.join(folder, "init.npy"), mmap_mode="r")
+        self.index = np.load(os.path.join(folder, "index.npy"), mmap_mode="r")
+        with open(os.path.join(folder, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.rows = np.arange(len(self.X)) if rows is None else np.asarray(rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        row = self.rows[i]
+        return (torch.from_numpy(np.array(self.X[row])), torch.from_numpy(np.array(self.init[row]))), torch.from_numpy(np.array(self.y[row]))
+
+    def split(self, train_size, seed=42):
+        """Random train/test split of the rows, `train_size` being a count or a fraction."""
+        rows = np.random.default_rng(seed).permutation(self.rows)
+        n = train_size if isinstance(train_size, int) else int(train_size * len(rows))
+        return WindowDataset(self.folder, rows[:n]), WindowDataset(self.folder, rows[n:])
+
+    def iter_batches(self, batch_size=65536, flat=False):
+        """
+        Iterate over (X, y) numpy batches of sorted rows. With flat=True the windows are
+        flattened and followed by the init columns, and y is the last hour of the target,
+        the layout of the random forest.
+        """
+        for start in range(0, len(self.rows), batch_size):
+            rows = np.sort(self.rows[start:start + batch_size])
+            X, y = self.X[rows], self.y[rows]
+            if flat:
+                yield np.hstack((X.reshape(len(rows), -1), self.init[rows])), y[:, -1]
+            else:
+                yield (X, self.init[rows]), y
+
+    def to_arrays(self, flat=True):
+        """All rows as in-memory arrays, for estimators that need the whole training set."""
+        batches = list(self.iter_batches(flat=flat))
+        if flat:
+            return np.concatenate([X for X, _ in batches]), np.concatenate([y for _, y in batches])
+        return (np.concatenate([X for (X, _), _ in batches]), np.concatenate([init for (_, init), _ in batches])), np.concatenate([y for _, y in batches])
+
+
+if __name__ == "__main__":
+    build_dataset("data/training/random_forest")
+    build_dataset("data/training/gru", wind_components=True)
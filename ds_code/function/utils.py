@@ -1,5 +1,11 @@
 import pandas as pd
 import numpy as np
+try:
+    import storage
+    import metrics
+except ImportError:                         # imported as ds_code.function.utils from the notebooks
+    from . import storage
+    from . import metrics
 
 def group_data(region_folder, src_folder, filename, to_csv=True, src='data'):
     """Group files in a folder to a big file containing infomation of multiple location."""
@@ -11,7 +17,7 @@ def group_data(region_folder, src_folder, filename, to_csv=True, src='data'):
         row = df.loc[i]
         key = row["city"] + ', ' + row["country"]
         keys.append(key)
-        city_df = pd.read_csv(src + '/' + src_folder + "/" + str(row["id"]) + ".csv").set_index("time")
+        city_df = storage.read_table(src + '/' + src_folder, row["id"]).set_index("time")
         city_dfs.append(city_df)
         
     region_df = pd.concat(city_dfs, axis=1, keys=keys)
@@ -21,12 +27,38 @@ def group_data(region_folder, src_folder, filename, to_csv=True, src='data'):
         return region_df
     
     
-def group_weather_data(region_folder, filename="weather.csv"):
-    group_data(region_folder, "weather", filename)
+def cube_folder(region_folder, src_folder, src='data'):
+    return src + "/region/" + region_folder + "/" + src_folder
+
+
+@metrics.timed("group_seconds")
+def group_cube(region_folder, src_folder, src='data', save=True):
+    """
+    Group files of the cities of a region to a dense (time, province, feature)
+    cube, provinces following the order of cities.csv.
+    """
+    ids = pd.read_csv("data/region/" + region_folder + "/cities.csv")["id"].to_numpy()
+    tables = [storage.read_arrays(src + '/' + src_folder, i) for i in ids]
+    cube = storage.Cube.stack(ids, tables)
+    if save:
+        cube.save(cube_folder(region_folder, src_folder, src))
+    return cube
+
+
+def read_cube(region_folder, src_folder, src='data', mmap=True):
+    """Memory-map the cube of a region, grouping it again if its city files changed since."""
+    folder = cube_folder(region_folder, src_folder, src)
+    if storage.cube_is_stale(folder, src + '/' + src_folder):
+        group_cube(region_folder, src_folder, src)
+    return storage.Cube.load(folder, mmap)
+    
+    
+def group_weather_data(region_folder):
+    group_cube(region_folder, "weather")
     
     
-def group_aqi_data(region_folder, filename="air_quality.csv"):
-    group_data(region_folder, "air_quality", filename)
+def group_aqi_data(region_folder):
+    group_cube(region_folder, "air_quality")
     
     
 def read_group_data(path_from_region):
@@ -34,61 +66,147 @@ def read_group_data(path_from_region):
     return pd.read_csv(path, index_col=0, header=[0, 1])
 
 
-def sliding_window(weather_df, air_df, window_size=4, target_size="same"):           # target_size is either "one" or "same"
+def to_epoch(time_col):
+    """Convert a column of timestamps to int64 epoch seconds."""
+    return pd.to_datetime(time_col).to_numpy().astype("datetime64[s]").astype(np.int64)
+
+
+def contiguous_runs(epochs, step=3600):
+    """
+    Find runs of consecutive timestamps spaced exactly `step` seconds apart.
+    Return an array of (start, stop) row positions, stop being exclusive.
+    """
+    n = len(epochs)
+    if n == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(epochs) != step) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [n]))
+    return np.stack((starts, stops), axis=1)
+
+
+def epoch_runs(epochs, step=3600):
+    """(first, last) epochs of the runs of consecutive timestamps, as an int64 array of shape (runs, 2)."""
+    epochs = np.asarray(epochs, dtype=np.int64)
+    runs = contiguous_runs(epochs, step)
+    return np.stack((epochs[runs[:, 0]], epochs[runs[:, 1] - 1]), axis=1)
+
+
+def intersect_runs(a, b):
+    """Intersection of two sorted arrays of disjoint closed (first, last) runs."""
+    a, b = np.asarray(a, dtype=np.int64).reshape(-1, 2), np.asarray(b, dtype=np.int64).reshape(-1, 2)
+    # runs of b overlapping each run of a: from the first ending after its start to the last starting before its end
+    lo = np.searchsorted(b[:, 1], a[:, 0])
+    hi = np.searchsorted(b[:, 0], a[:, 1], side="right")
+    counts = np.maximum(hi - lo, 0)
+    i = np.repeat(np.arange(len(a)), counts)
+    j = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    return np.stack((np.maximum(a[i, 0], b[j, 0]), np.minimum(a[i, 1], b[j, 1])), axis=1)
+
+
+def in_runs(epochs, runs, span=0):
+    """Mask of the epochs `e` such that [e - span, e] lies inside one of the sorted closed `runs`."""
+    runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+    epochs = np.asarray(epochs, dtype=np.int64)
+    if len(runs) == 0:
+        return np.zeros(len(epochs), dtype=bool)
+    i = np.searchsorted(runs[:, 0], epochs, side="right") - 1
+    run = runs[i.clip(min=0)]
+    return (i >= 0) & (epochs <= run[:, 1]) & (epochs - span >= run[:, 0])
+
+
+def window_ends(epochs, window_size=4, step=3600):
+    """Row positions where a gap-free window of `window_size` rows ends."""
+    runs = contiguous_runs(epochs, step)
+    runs = runs[runs[:, 1] - runs[:, 0] >= window_size]
+    if len(runs) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([np.arange(a + window_size - 1, b) for a, b in runs])
+
+
+def window_view(values, window_size=4):
+    """
+    Zero-copy view of all windows over the first axis of `values`, with shape
+    (len(values) - window_size + 1, window_size, *values.shape[1:]).
+    """
+    if len(values) < window_size:
+        return np.empty((0, window_size) + values.shape[1:], dtype=values.dtype)
+    view = np.lib.stride_tricks.sliding_window_view(values, window_size, axis=0)
+    return np.moveaxis(view, -1, 1)
+
+
+def take_windows(view, ends, window_size=4, copy=True):
+    """
+    Select the windows ending at row positions `ends` from a `window_view`.
+    With copy=False and `ends` forming one unbroken range, a slice of the view
+    is returned instead of a gathered copy.
+    """
+    first = ends - window_size + 1
+    if not copy and len(ends) > 0 and ends[-1] - ends[0] == len(ends) - 1:
+        return view[first[0]: first[-1] + 1]
+    return view[first]
+
+
+def align_to(epochs, src_epochs, src_values):
+    """
+    Reindex `src_values` (rows stamped by sorted `src_epochs`) onto `epochs`.
+    Return the aligned array (NaN where missing) and a presence mask.
+    """
+    aligned = np.full((len(epochs),) + src_values.shape[1:], np.nan)
+    if len(src_epochs) == 0:
+        return aligned, np.zeros(len(epochs), dtype=bool)
+    pos = np.searchsorted(src_epochs, epochs).clip(max=len(src_epochs) - 1)
+    present = src_epochs[pos] == epochs
+    aligned[present] = src_values[pos[present]]
+    return aligned, present
+
+
+@metrics.timed("window_seconds", fn="sliding_window")
+def sliding_window(weather_df, air_df, window_size=4, target_size="same", copy=True, return_time=False, runs=None):           # target_size is either "one" or "same"
     """
     Create windows for data preprocessing step, with n hours of weather data
     and corresponding 1 hour of AQI data (target_size="one") or n hours of AQI
     data (target_size="same").
+    Set copy=False to get strided views instead of copies when possible, and
+    return_time=True to also get the epoch of the last hour of every window.
+    With `runs` (e.g. from the coverage index) only the windows inside one of these
+    (first, last) epoch runs are kept.
     """
-    X = []
-    y = []
-    w_df = weather_df[:]
-    a_df = air_df[:]
-    w_df["time"] = pd.to_datetime(w_df["time"])
-    a_df["time"] = pd.to_datetime(a_df["time"])
-    w_df.set_index("time", inplace=True)
-    a_df.set_index("time", inplace=True)
-    weather_time_idx = w_df.index
+    w_time = to_epoch(weather_df["time"])
+    a_time = to_epoch(air_df["time"])
+    w_values = weather_df.drop(columns="time").to_numpy()
+    a_values, present = align_to(w_time, a_time, air_df.drop(columns="time").to_numpy())
     
-    for i in range(window_size - 1, len(weather_df)):
-        w_start, w_end = weather_time_idx[i - window_size + 1], weather_time_idx[i]
-        if (w_end - w_start).seconds == 3600 * (window_size - 1):
-            try:
-                if target_size == "one":
-                    a_value = a_df.loc[w_end].values
-                elif target_size == "same":
-                    a_value = a_df.loc[w_start: w_end].values
-                    if len(a_value) != window_size:
-                        continue 
-                    
-                w_value = w_df.loc[w_start: w_end].values
-                X.append(w_value)
-                y.append(a_value)
-            except:
-                continue
-            
-    return np.array(X), np.array(y)
-
-def predict_window(weather_df, window_size=4):
+    ends = window_ends(w_time, window_size)
+    if runs is not None:
+        ends = ends[in_runs(w_time[ends], runs, (window_size - 1) * 3600)]
+    if target_size == "one":
+        ends = ends[present[ends]]
+    elif target_size == "same":
+        covered = np.concatenate(([0], np.cumsum(present)))
+        ends = ends[covered[ends + 1] - covered[ends + 1 - window_size] == window_size]
+        
+    X = take_windows(window_view(w_values, window_size), ends, window_size, copy)
+    if target_size == "one":
+        y = a_values[ends]
+    else:
+        y = take_windows(window_view(a_values, window_size), ends, window_size, copy)
+    if return_time:
+        return X, y, w_time[ends]
+    return X, y
+
+@metrics.timed("window_seconds", fn="predict_window")
+def predict_window(weather_df, window_size=4, copy=True, runs=None):
     """
     Create windows for data preprocessing step of large scale prediction, 
-    using whole weather data table of a province.
+    using whole weather data table of a province, optionally only inside `runs`.
     """
-    X = []
-    valid = []
-    w_df = weather_df[:]
-    w_df["time"] = pd.to_datetime(w_df["time"])
-    w_df.set_index("time", inplace=True)
-    weather_time_idx = w_df.index
-    
-    for i in range(window_size - 1, len(weather_df)):
-        w_start, w_end = weather_time_idx[i - window_size + 1], weather_time_idx[i]
-        if (w_end - w_start).seconds == 3600 * (window_size - 1):
-            w_value = w_df.loc[w_start: w_end].values
-            X.append(w_value)
-            valid.append(i)
-            
-    return weather_time_idx[valid], np.array(X)
+    w_time = to_epoch(weather_df["time"])
+    ends = window_ends(w_time, window_size)
+    if runs is not None:
+        ends = ends[in_runs(w_time[ends], runs, (window_size - 1) * 3600)]
+    X = take_windows(window_view(weather_df.drop(columns="time").to_numpy(), window_size), ends, window_size, copy)
+    return pd.DatetimeIndex(pd.to_datetime(weather_df["time"]))[ends], X
 
     
 if __name__ == "__main__":
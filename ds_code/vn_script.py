@@ -1,6 +1,9 @@
+import sys
 import pandas as pd
-from function.scraper import AQIScraper, WeatherScraper
-from function.utils import *
+sys.path.append("ds_code/function")
+from scraper import AQIScraper, WeatherScraper
+from utils import *
+import metrics
 # script for scraping data
 if __name__ == "__main__":
     # create dataframe for the region
@@ -13,10 +16,14 @@ if __name__ == "__main__":
     weather_scraper = WeatherScraper()
     aqi_scraper = AQIScraper()
 
-    # scraping
-    weather_scraper.mass_scrape(df)
-    aqi_scraper.mass_scrape(df)
+    # scraping, only the hours missing from data/ are requested
+    weather_scraper.mass_scrape(df, append=True)
+    aqi_scraper.mass_scrape(df, append=True)
 
     # concanate multiple city files --> regional files
     group_weather_data("vietnam")
-    group_aqi_data("vietnam")
\ No newline at end of file
+    group_aqi_data("vietnam")
+    
+    # stage timings and request counters, with DS_METRICS=1
+    if metrics.enabled():
+        metrics.dump("metrics/vn_script.jsonl")
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of ds_code/function import each other flat, as in the scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ds_code", "function"))
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pytest
+import torch
+from model_wrapper import ConvLSTMPredictor, cube_features
+from models import ConvLSTMTimeSeries
+from utils import group_cube
+import metrics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def predictor(monkeypatch):
+    """ConvLSTM predictor with random weights and the checked-in scalers."""
+    monkeypatch.chdir(ROOT)
+    torch.manual_seed(0)
+    model = ConvLSTMTimeSeries(input_dim=63, hidden_dim=[256], input_width=9, output_width=6).eval()
+    monkeypatch.setattr(ConvLSTMPredictor, "load_model", lambda self, model_dir: model)
+    return ConvLSTMPredictor()
+
+
+@pytest.fixture
+def forecast():
+    cube = group_cube("vietnam", "weather", src=os.path.join(ROOT, "forecast"), save=False)
+    ids, weather = cube_features(cube)
+    return ids, cube.time, np.nan_to_num(weather)
+
+
+@pytest.mark.parametrize("shift, revised, appended, predicted",
+                         [(0, None, 1, 1), (0, None, 2, 2), (0, None, 5, 5), (24, None, 6, 6), (24, -30, 6, 30), (0, -3, 2, 3)])
+def test_predict_stream(predictor, forecast, monkeypatch, shift, revised, appended, predicted):
+    ids, time, weather = forecast
+    first = predictor.predict_stream(weather[:, :-appended], time[:-appended], ids)
+    np.testing.assert_allclose(first, predictor.predict_weather(weather[:, :-appended]), atol=1e-3)
+
+    # the next scrape drops the first hours, revises one and appends new ones
+    weather, time = weather[:, shift:].copy(), time[shift:]
+    if revised is not None:
+        weather[:, revised] += 1
+    monkeypatch.setattr(metrics, "_enabled", True)
+    metrics.reset()
+    output = predictor.predict_stream(weather, time, ids)
+    # only the hours from the revised one on go through the model again
+    assert [m["sum"] for m in metrics.snapshot() if m["name"] == "stream_hours"] == [predicted]
+    np.testing.assert_allclose(output, predictor.predict_weather(weather), atol=1e-3)
@@ -0,0 +1,135 @@
+import json
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+import pytest
+import scraper
+import storage
+
+
+class FakeClock:
+    """monotonic and sleep of the scraper module, sleeping without waiting."""
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scraper, "monotonic", clock.monotonic)
+    monkeypatch.setattr(scraper, "sleep", clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def stub():
+    """
+    Open-Meteo stub answering the responses scripted per latitude in `stub.script`
+    (status, headers and optionally a raw body, the last one repeating), 200 with a day of
+    hourly weather by default.
+    """
+    requests = Counter()
+    script = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            lat = query["lat"]
+            n = requests[lat]
+            requests[lat] += 1
+            responses = script.get(lat, [])
+            status, headers, *body = responses[min(n, len(responses) - 1)] if responses else (200, {})
+            if body:
+                body = body[0]
+            elif status == 200:
+                start = datetime.strptime(query["start"], "%Y-%m-%d")
+                body = json.dumps({"hourly": {
+                    "time": [(start + timedelta(hours=h)).strftime("%Y-%m-%dT%H:%M") for h in range(24)],
+                    "temperature_2m": [20.0] * 24}}).encode()
+            else:
+                body = b"{}"
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.requests, server.script = requests, script
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/archive?lat={{}}&lng={{}}&start={{}}&end={{}}"
+    yield server
+    server.shutdown()
+
+
+def test_retries_and_report(tmp_path, clock, stub):
+    stub.script.update({
+        "1": [(429, {"Retry-After": "7"}), (500, {}), (200, {})],
+        "2": [(404, {})],
+        "3": [(500, {})],                       # fails on every attempt
+    })
+    weather_scraper = scraper.WeatherScraper(rate=None, workers=1, max_retries=3, backoff=0.5)
+    weather_scraper.raw_url = stub.url
+    weather_scraper.folder = str(tmp_path)
+    cities = pd.DataFrame({"id": [11, 12, 13, 14], "lat": [1, 2, 3, 4], "lng": [0, 0, 0, 0]})
+    report = weather_scraper.mass_scrape(cities, "2024-01-01", "2024-01-01")
+
+    # 429 honors Retry-After, the 500 after it backs off exponentially
+    assert stub.requests["1"] == 3
+    assert stub.requests["2"] == 1              # client errors are not retried
+    assert stub.requests["3"] == 4              # max_retries + 1 attempts
+    assert stub.requests["4"] == 1
+    assert clock.sleeps == [7, 0.5 * 2, 0.5, 0.5 * 2, 0.5 * 4]
+
+    assert list(report.index) == ["11", "12", "13", "14"]
+    assert report["ok"].tolist() == [True, False, False, True]
+    assert report.loc["13", "error"] == "request failed"
+    assert report.loc[["11", "14"], "error"].isna().all()
+    for name in ["11", "14"]:
+        assert len(storage.read_table(str(tmp_path), name)) == 24
+    assert not storage.exists(str(tmp_path), "13")
+
+
+def test_retry_delays(clock, stub):
+    stub.script.update({
+        "1": [(429, {"Retry-After": "0"}), (503, {"Retry-After": "3600"}), (500, {}), (200, {})],
+        "2": [(200, {}, b"<html>busy</html>")],  # malformed body on every attempt
+    })
+    weather_scraper = scraper.WeatherScraper(rate=None, workers=1, max_retries=3, backoff=1, max_delay=5)
+    weather_scraper.raw_url = stub.url
+
+    # Retry-After 0 is honored, not taken as missing, and every delay is capped by max_delay
+    assert weather_scraper.get_json(1, 0, "2024-01-01", "2024-01-01")
+    assert clock.sleeps == [0, 5, 4]
+    clock.sleeps.clear()
+
+    assert not weather_scraper.get_json(2, 0, "2024-01-01", "2024-01-01")
+    assert stub.requests["2"] == 4
+    assert clock.sleeps == [1, 2, 4]
+
+
+def test_token_bucket(clock):
+    bucket = scraper.TokenBucket(rate=2, capacity=2)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == [0.5]
+
+    # a 429 pause drains the bucket below zero for `seconds`
+    bucket.pause(1)
+    bucket.acquire()
+    assert sum(clock.sleeps[1:]) == pytest.approx(1.5)
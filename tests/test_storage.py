@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import storage
+import coverage_index
+
+
+def weather(start, periods, empty=0):
+    """Hourly table of two columns whose last `empty` rows have no value."""
+    df = pd.DataFrame({"time": pd.date_range(start, periods=periods, freq="h").strftime("%Y-%m-%dT%H:%M"),
+                       "temperature_2m": np.arange(periods, dtype=float),
+                       "cloud_cover": np.arange(periods, dtype=float) * 2})
+    df.iloc[periods - empty:, 1:] = np.nan
+    return df
+
+
+@pytest.mark.parametrize("fmt", ["csv", "npy"])
+def test_append_fills_empty_tail(tmp_path, fmt):
+    folder = str(tmp_path)
+    storage.write_table(weather("2024-11-15", 48, empty=40), folder, "1", fmt)
+    coverage_index.update(folder, "1")
+    assert storage.last_time(folder, "1") == pd.Timestamp("2024-11-15T07:00")
+
+    new = weather("2024-11-15", 72)
+    assert storage.append_table(new, folder, "1") == 64
+    df = storage.read_table(folder, "1")
+    assert len(df) == 72
+    assert df["time"].is_monotonic_increasing and not df["time"].duplicated().any()
+    assert not df.drop(columns="time").isna().any().any()
+    np.testing.assert_allclose(df["temperature_2m"], new["temperature_2m"])
+    assert storage.last_time(folder, "1") == pd.Timestamp("2024-11-17T23:00")
+
+    # the index of the empty tail is replaced by the appended rows
+    index = coverage_index.update(folder, "1")
+    built = coverage_index.Coverage.build(*storage.read_arrays(folder, "1")[:2])
+    np.testing.assert_array_equal(index.flags, built.flags)
+    np.testing.assert_array_equal(index.present, built.present)
+    assert index.last == built.last
+
+
+def test_last_time_of_empty_table(tmp_path):
+    folder = str(tmp_path)
+    storage.write_table(weather("2024-11-15", 5000, empty=5000), folder, "1", "csv")
+    assert storage.last_time(folder, "1") is None
+    assert storage.append_table(weather("2024-11-15", 3), folder, "1") == 3
+    assert len(storage.read_table(folder, "1")) == 3
+
+
+def cube(start, hours, fill=0):
+    time = 1700000000 + 3600 * np.arange(start, start + hours, dtype=np.int64)
+    values = (fill + np.arange(start, start + hours, dtype=np.float32)).reshape(-1, 1, 1).repeat(2, 1).repeat(3, 2)
+    return storage.Cube(time, [1, 2], ["a", "b", "c"], values)
+
+
+def tight_header(folder, hours):
+    """Save a cube whose values header has no padding left for a longer shape."""
+    c = cube(0, hours)
+    c.save(folder)
+    header = str({"descr": "<f4", "fortran_order": False, "shape": c.values.shape}) + "\n"
+    with open(os.path.join(folder, "values.npy"), "wb") as f:
+        f.write(b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1"))
+        f.write(c.values.tobytes())
+
+
+@pytest.mark.parametrize("hours", [48, 20])
+def test_save_at(tmp_path, hours):
+    folder = str(tmp_path)
+    cube(0, 30).save(folder)
+    cube(10, hours, fill=0.5).save_at(folder, 10)
+    saved = storage.Cube.load(folder)
+    expected = np.concatenate((cube(0, 10).values, cube(10, hours, fill=0.5).values))
+    np.testing.assert_array_equal(saved.values, expected)
+    np.testing.assert_array_equal(saved.time, cube(0, 10 + hours).time)
+
+
+def test_save_at_interrupted(tmp_path):
+    folder = str(tmp_path)
+    cube(0, 30).save(folder)
+    time = np.load(os.path.join(folder, "time.npy"))
+    cube(30, 10).save_at(folder, 30)
+    # values written but time.npy not swapped yet: the previous hours are loaded
+    np.save(os.path.join(folder, "time.npy"), time)
+    saved = storage.Cube.load(folder)
+    assert len(saved.time) == len(saved.values) == 30
+    cube(30, 10).save_at(folder, 30)
+    assert len(storage.Cube.load(folder).values) == 40
+
+
+def test_save_at_without_header_room(tmp_path):
+    folder = str(tmp_path)
+    tight_header(folder, 9)
+    assert len(storage.Cube.load(folder).time) == 9
+    cube(9, 91).save_at(folder, 9)
+    saved = storage.Cube.load(folder)
+    np.testing.assert_array_equal(saved.values, cube(0, 100).values)
@@ -1,18 +1,25 @@
 import sys
+import json
 import geopandas as gpd
 import folium
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import branca.colormap as cm
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QWidget, QMessageBox,
-    QCalendarWidget, QLabel, QHBoxLayout, QPushButton, QSpinBox, QComboBox
+    QCalendarWidget, QLabel, QHBoxLayout, QPushButton, QSpinBox, QComboBox, QSlider
 )
 from PyQt5.QtWebEngineWidgets import QWebEngineView
-from PyQt5.QtCore import QTimer, QTime, Qt, QRectF, QPointF
+from PyQt5.QtCore import QTimer, QTime, QDate, Qt, QRectF, QPointF, QObject, QRunnable, QThreadPool, pyqtSignal
 from PyQt5.QtGui import QPainter, QPolygon, QColor, QPen
 from PyQt5.QtCore import QPoint
+from collections import OrderedDict, deque
+from threading import Lock
+from time import perf_counter
+
+sys.path.append("ds_code/function")
+from repository import shared_repository, invalidated
+import metrics
 
 
 class AnalogClock(QWidget):
@@ -99,6 +106,29 @@ class AnalogClock(QWidget):
         painter.restore()
 
 
+class PayloadSignals(QObject):
+    done = pyqtSignal(object, object)
+
+
+class PayloadWorker(QRunnable):
+    """Compute the payload of one animation frame off the GUI thread."""
+    def __init__(self, app, key):
+        super().__init__()
+        self.app = app
+        self.key = key
+        self.signals = app.payload_signals
+
+    def run(self):
+        # always report back, so that the key leaves `prefetching` and the frame can be requested again
+        payload = None
+        try:
+            payload = self.app.get_payload(*self.key)
+        except Exception:
+            metrics.count("map_payload_errors")
+        finally:
+            self.signals.done.emit(self.key, payload)
+
+
 class MapApp(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -109,11 +139,14 @@ class MapApp(QMainWindow):
         map_df = gpd.read_file("vnmap/vn_shp/vn.shp", encoding='utf-8').drop("id", axis=1)
         city_df = pd.read_csv("data/region/vietnam/cities.csv").loc[:, ["admin_name", "id"]]
         self.base_df = map_df.merge(city_df, left_on="name", right_on="admin_name")
+        # geometry sent once to the browser, simplified to keep the page small
+        self.geo_df = self.base_df.loc[:, ["id", "name", "geometry"]]
+        self.geo_df["geometry"] = self.geo_df.geometry.simplify(0.005, preserve_topology=True)
+        self.province_ids = self.geo_df["id"].tolist()
         
-        self.weather_db = {i: pd.read_csv("forecast/weather/" + str(i) + ".csv").set_index("time") for i in self.base_df["id"]}
-        self.aqi_forest_db = {i: pd.read_csv("forecast/aqi/random_forest/" + str(i) + ".csv").set_index("time") for i in self.base_df["id"]}
-        self.aqi_gru_db = {i: pd.read_csv("forecast/aqi/gru/" + str(i) + ".csv").set_index("time") for i in self.base_df["id"]}
-        self.aqi_convlstm_db = {i: pd.read_csv("forecast/aqi/conv_lstm/" + str(i) + ".csv").set_index("time") for i in self.base_df["id"]}
+        # forecast cubes are loaded when a model is first selected
+        self.repository = shared_repository("vietnam")
+        self.model_names = {"Random Forest": "random_forest", "GRU": "gru", "ConvLSTM": "conv_lstm"}
         
         # range for colormap
         self.attr_range = {"temperature_2m": (0, 40),
@@ -128,12 +161,37 @@ class MapApp(QMainWindow):
                            "o3": (0, 180),
                            "so2": (0, 350),
                            "no2": (0, 200),
-                           "co": (0, 15400)}
+                           "co": (0, 15400),
+                           "aqi": (0, 500)}
         
         # create color map
         color_func = lambda r, g, b: "#%02x%02x%02x" % (int(r * 255), int(g * 255), int(b * 255))
         self.weather_cmap = [color_func(*plt.cm.jet(v)[:3]) for v in range(256)]
         self.aqi_cmap = [color_func(*plt.cm.jet(v)[:3]) for v in range(110, 256)]
+        # hex lookup table of each attribute
+        aqi_attrs = ["co", "no2", "o3", "so2", "pm2_5", "pm10", "aqi"]
+        self.color_lut = {attr: np.array(self.aqi_cmap if attr in aqi_attrs else self.weather_cmap) for attr in self.attr_range}
+        
+        # rendered payloads per (source, model, attribute, time)
+        self.payload_cache = OrderedDict()
+        self.payload_cache_size = 1024
+        self.payload_lock = Lock()
+        self.repository.listeners.append(self.drop_payloads)
+        self.map_ready = False
+        self.pending_payload = None
+        
+        # animation frames, computed ahead in a thread pool
+        self.frame_selection = None
+        self.frame_times = []
+        self.current_key = None
+        self.prefetch_size = 24
+        self.prefetching = set()
+        self.shown_at = deque(maxlen=10)
+        self.requested_at = perf_counter()
+        self.payload_signals = PayloadSignals()
+        self.payload_signals.done.connect(self.on_payload_ready)
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(2)
 
         # Initialize UI components
         self.init_ui()
@@ -157,6 +215,8 @@ class MapApp(QMainWindow):
         self.hour_spinbox.setValue(current_time.hour())
 
         self.browser = QWebEngineView()
+        self.browser.loadFinished.connect(self.on_map_loaded)
+        self.browser.setHtml(self.create_map())
 
         self.model_combobox1 = QComboBox()
         self.model_combobox1.addItems(["Random Forest", "ConvLSTM", "GRU"])
@@ -167,9 +227,22 @@ class MapApp(QMainWindow):
         self.weather_attr.addItems(["temperature_2m", "relative_humidity_2m", "dew_point_2m", "precipitation",
                                     "surface_pressure", "cloud_cover", "wind_speed_10m"])
         self.aqi_attr = QComboBox()
-        self.aqi_attr.addItems(["co", "no2", "o3", "so2", "pm2_5", "pm10"])
+        self.aqi_attr.addItems(["co", "no2", "o3", "so2", "pm2_5", "pm10", "aqi"])
         self.confirm_button = QPushButton("Confirm")
         self.confirm_button.clicked.connect(self.update_map)
+        
+        self.time_slider = QSlider(Qt.Horizontal)
+        self.time_slider.setRange(0, 0)
+        self.time_slider.valueChanged.connect(self.show_frame)
+        self.play_button = QPushButton("Play")
+        self.play_button.clicked.connect(self.toggle_play)
+        self.fps_spinbox = QSpinBox()
+        self.fps_spinbox.setRange(1, 30)
+        self.fps_spinbox.setValue(4)
+        self.fps_spinbox.valueChanged.connect(lambda fps: self.play_timer.setInterval(1000 // fps))
+        self.frame_label = QLabel()
+        self.play_timer = QTimer(self)
+        self.play_timer.timeout.connect(self.next_frame)
 
         # Layout
         left_layout = QVBoxLayout()
@@ -184,6 +257,14 @@ class MapApp(QMainWindow):
 
         right_layout = QVBoxLayout()
         right_layout.addWidget(self.browser)
+        
+        animation_controls = QHBoxLayout()
+        animation_controls.addWidget(self.play_button)
+        animation_controls.addWidget(self.time_slider)
+        animation_controls.addWidget(QLabel("FPS:"))
+        animation_controls.addWidget(self.fps_spinbox)
+        animation_controls.addWidget(self.frame_label)
+        right_layout.addLayout(animation_controls)
 
         self.model_label = QLabel("Select Model:")
         left_layout.addWidget(self.model_label)
@@ -223,8 +304,13 @@ class MapApp(QMainWindow):
             self.aqi_attr.show()
             self.weather_attr.hide()
         
-    def color_func(self, low, high, cmap):
-        return lambda value: cmap[round(min(max((value - low) / (high - low), 0), 1) * (len(cmap) - 1))]
+    def colorize(self, attr, values):
+        """Hex colors of an array of values, clipped to the range of the attribute, grey for missing values."""
+        low, high = self.attr_range[attr]
+        lut = self.color_lut[attr]
+        scaled = np.clip((values - low) / (high - low), 0, 1) * (len(lut) - 1)
+        colors = lut[np.rint(np.nan_to_num(scaled)).astype(np.intp)]
+        return np.where(np.isnan(values), "#808080", colors)
     
     def get_selected_time(self):
         """Get time from hour spinbox and calendar, then make a Datetime string."""
@@ -233,42 +319,167 @@ class MapApp(QMainWindow):
         hour = self.hour_spinbox.value()
         return f"{year}-{month:02}-{day:02}T{hour:02}:00"
         
-    def set_dataframe(self):
-        """Create dataframe for visualization."""
-        self.show_df = self.base_df.loc[:]
-        selected_time = self.get_selected_time()
-        
+    def get_selection(self):
+        """Source, model and attribute chosen in the comboboxes."""
         if self.model_combobox2.currentText() == "Weather":
-            self.attr = self.weather_attr.currentText()
-            self.cmap = self.weather_cmap
-            db = self.weather_db
-        else:
-            self.attr = self.aqi_attr.currentText()
-            self.cmap = self.aqi_cmap
-            if self.model_combobox1.currentText() == "Random Forest":
-                db = self.aqi_forest_db
-            elif self.model_combobox1.currentText() == "GRU":
-                db = self.aqi_gru_db
-            else:
-                db = self.aqi_convlstm_db
-                
-        self.low, self.high = self.attr_range[self.attr]
-        self.show_df[self.attr] = [max(db[i].loc[selected_time, self.attr], 0) for i in self.base_df["id"]]
-        self.show_df["color"] = self.show_df[self.attr].apply(self.color_func(self.low, self.high, self.cmap))
+            return "weather", None, self.weather_attr.currentText()
+        attr = self.aqi_attr.currentText()
+        source = "aqi_index" if attr == "aqi" else "aqi"
+        return source, self.model_names[self.model_combobox1.currentText()], attr
+        
+    def get_payload(self, source, model, attr, selected_time):
+        """JSON of the province ids with their values and colors, and the legend of a selection, cached. Thread-safe."""
+        key = (source, model, attr, selected_time)
+        payload = self.cached_payload(key)
+        metrics.count("map_payload_requests", cached=payload is not None)
+        if payload is not None:
+            return payload
+        
+        with metrics.timer("map_payload_seconds"):
+            return self.build_payload(key)
+        
+    def build_payload(self, key):
+        source, model, attr, selected_time = key
+        low, high = self.attr_range[attr]
+        lut = self.color_lut[attr]
+        values = np.maximum(self.repository.values(source, model, selected_time, self.province_ids, attr).astype(float), 0)
+        payload = json.dumps({
+            "attr": attr,
+            "ids": self.province_ids,
+            "values": np.round(values, 2).tolist(),
+            "colors": self.colorize(attr, values).tolist(),
+            "legend": {"low": low, "high": high, "colors": lut[::max(len(lut) // 10, 1)].tolist()},
+        })
+        with self.payload_lock:
+            self.payload_cache[key] = payload
+            while len(self.payload_cache) > self.payload_cache_size:
+                self.payload_cache.popitem(last=False)
+        return payload
+    
+    def drop_payloads(self, source=None, model=None):
+        """Drop the payloads rendered from cubes the repository invalidated."""
+        with self.payload_lock:
+            for key in [key for key in self.payload_cache if invalidated(key, source, model)]:
+                del self.payload_cache[key]
+
+    def cached_payload(self, key):
+        with self.payload_lock:
+            if key in self.payload_cache:
+                self.payload_cache.move_to_end(key)
+                return self.payload_cache[key]
+        return None
 
     def update_map(self):
         """Update map when the "Confirm" button is clicked."""
         try:
-            self.set_dataframe()
-            self.browser.setHtml(self.create_map())
+            selected_time = self.get_selected_time()
+            payload = self.get_payload(*self.get_selection(), selected_time)
+            self.load_frames(selected_time)
         except:
             message_box = QMessageBox()
             message_box.setWindowTitle("Warning")
             message_box.setText("Chosen date is out of 7-day range from last data scrapping attempt.")
             message_box.exec()
+            return
+        self.push_payload(payload)
+        
+    def push_payload(self, payload):
+        """Recolor the provinces of the loaded map, or keep the payload until the page is ready."""
+        if self.map_ready:
+            metrics.count("map_updates")
+            self.browser.page().runJavaScript(f"updateChoropleth({payload});")
+        else:
+            self.pending_payload = payload
+            
+    def load_frames(self, selected_time=None):
+        """Put the hours of the selected forecast on the time slider."""
+        source, model, attr = self.get_selection()
+        self.frame_selection = (source, model, attr)
+        self.frame_times = list(self.repository.get(source, model).time_index.strftime("%Y-%m-%dT%H:00"))
+        frame = self.frame_times.index(selected_time) if selected_time in self.frame_times else 0
+        self.time_slider.blockSignals(True)
+        self.time_slider.setRange(0, len(self.frame_times) - 1)
+        self.time_slider.setValue(frame)
+        self.time_slider.blockSignals(False)
+        self.current_key = self.frame_selection + (self.frame_times[frame],)
+        self.prefetch(range(frame + 1, frame + 1 + self.prefetch_size))
+        
+    def toggle_play(self):
+        if self.play_timer.isActive():
+            self.play_timer.stop()
+            self.play_button.setText("Play")
+            return
+        try:
+            self.load_frames(self.current_key[-1] if self.current_key else None)
+        except FileNotFoundError:
+            return
+        self.shown_at.clear()
+        self.play_timer.start(1000 // self.fps_spinbox.value())
+        self.play_button.setText("Pause")
+        
+    def next_frame(self):
+        """Advance the animation, holding the current frame until the next one is computed."""
+        if self.get_selection() != self.frame_selection:
+            try:
+                self.load_frames(self.current_key[-1])
+            except Exception:
+                # no frames for the new selection, stop instead of raising in every timer tick
+                self.play_timer.stop()
+                self.play_button.setText("Play")
+                return
+        frame = (self.time_slider.value() + 1) % len(self.frame_times)
+        key = self.frame_selection + (self.frame_times[frame],)
+        if self.cached_payload(key) is not None:
+            self.time_slider.setValue(frame)
+        else:
+            self.prefetch([frame])
+        
+    def show_frame(self, frame):
+        """Show a frame of the slider, from the cache or once a worker has computed it."""
+        if not self.frame_times:
+            return
+        self.requested_at = perf_counter()
+        self.current_key = self.frame_selection + (self.frame_times[frame],)
+        payload = self.cached_payload(self.current_key)
+        if payload is not None:
+            self.display_frame(self.current_key, payload)
+        else:
+            self.prefetch([frame])
+        self.prefetch(range(frame + 1, frame + 1 + self.prefetch_size))
+        
+    def prefetch(self, frames):
+        for frame in frames:
+            key = self.frame_selection + (self.frame_times[frame % len(self.frame_times)],)
+            if key not in self.prefetching and self.cached_payload(key) is None:
+                self.prefetching.add(key)
+                self.pool.start(PayloadWorker(self, key))
+                
+    def on_payload_ready(self, key, payload):
+        self.prefetching.discard(key)
+        if key == self.current_key and payload is not None:
+            self.display_frame(key, payload)
+            
+    def display_frame(self, key, payload):
+        """Push a frame to the map and update the time controls and the frame rate/latency readout."""
+        self.push_payload(payload)
+        now = perf_counter()
+        self.shown_at.append(now)
+        fps = (len(self.shown_at) - 1) / (now - self.shown_at[0]) if len(self.shown_at) > 1 else 0
+        self.frame_label.setText(f"{key[-1]}  {fps:.1f} fps  {(now - self.requested_at) * 1000:.0f} ms")
+        
+        t = pd.Timestamp(key[-1])
+        self.calendar.setSelectedDate(QDate(t.year, t.month, t.day))
+        self.hour_spinbox.setValue(t.hour)
+            
+    def on_map_loaded(self, ok):
+        self.map_ready = ok
+        if ok and self.pending_payload is not None:
+            self.push_payload(self.pending_payload)
+            self.pending_payload = None
     
+    @metrics.timed("map_render_seconds")
     def create_map(self):
-        """Draw map to visualize the dataframe after change."""
+        """Draw the base map with the provinces once, later updates only recolor them through updateChoropleth."""
         m = folium.Map(
             location=[14.0583, 108.2772],
             zoom_start=6,
@@ -276,21 +487,46 @@ class MapApp(QMainWindow):
             bounds=[[8.179, 102.144], [23.393, 109.463]]
         )
         
-        m.add_child(cm.LinearColormap(self.cmap, vmin=self.low, vmax=self.high))
-
-        folium.GeoJson(
-            self.show_df,
+        provinces = folium.GeoJson(
+            self.geo_df,
             name="Provinces",
             style_function=lambda feature: {
-                "fillColor": feature["properties"]["color"],
+                "fillColor": "#808080",
                 "color": "black",
                 "weight": 0.5,
                 "fillOpacity": 0.7,
             },
-            tooltip=folium.GeoJsonTooltip(fields=["name", self.attr], aliases=["Province:", self.attr]),
         ).add_to(m)
-
-        return m._repr_html_()
+        
+        m.get_root().html.add_child(folium.Element(
+            '<div id="legend" style="position: absolute; top: 10px; right: 10px; z-index: 1000; '
+            'background: white; padding: 6px; font: 12px sans-serif;"></div>'
+        ))
+        m.get_root().script.add_child(folium.Element("""
+            function updateChoropleth(payload) {
+                var position = {};
+                payload.ids.forEach(function (id, i) { position[id] = i; });
+                %s.eachLayer(function (layer) {
+                    var props = layer.feature.properties;
+                    var i = position[props.id];
+                    var text = props.name + "<br>" + payload.attr + ": " + (i === undefined ? "-" : payload.values[i]);
+                    layer.setStyle({fillColor: i === undefined ? "#808080" : payload.colors[i]});
+                    if (layer.getTooltip()) {
+                        layer.setTooltipContent(text);
+                    } else {
+                        layer.bindTooltip(text, {sticky: true});
+                    }
+                });
+                var legend = payload.legend;
+                document.getElementById("legend").innerHTML =
+                    "<b>" + payload.attr + "</b>" +
+                    "<div style='width: 200px; height: 10px; background: linear-gradient(to right, " + legend.colors.join(", ") + ");'></div>" +
+                    "<span>" + legend.low + "</span><span style='float: right;'>" + legend.high + "</span>";
+            }
+        """ % provinces.get_name()))
+
+        # full page rather than the iframe of _repr_html_, so updateChoropleth is reachable from runJavaScript
+        return m.get_root().render()
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)